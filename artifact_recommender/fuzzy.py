@@ -0,0 +1,107 @@
+from artifact_recommender import models
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+import Levenshtein
+
+CACHE_KEY = 'fuzzy:tree'
+# Ids below the highest known one which were not read yet, as tags of other
+# transactions may commit after higher ids, are read again while they are
+# among the last GAP_WINDOW ids
+GAP_WINDOW = 1000
+
+
+class BKTree(object):
+    # Burkhard-Keller tree over tag names using the Levenshtein distance,
+    # each node being a [name, {distance: child node}] pair.
+
+    def __init__(self, names=()):
+        self.root = None
+        self.last_tag_id = 0
+        self.missing_ids = set()
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        if self.root is None:
+            self.root = [name, {}]
+            return
+        node = self.root
+        while True:
+            distance = Levenshtein.distance(name, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [name, {}]
+                return
+            node = child
+
+    def search(self, name, max_distance):
+        found = set()
+        if self.root is None:
+            return found
+        pending = [self.root]
+        while pending:
+            node_name, children = pending.pop()
+            distance = Levenshtein.distance(name, node_name)
+            if distance <= max_distance:
+                found.add(node_name)
+            # Triangle inequality: only subtrees whose edge distance is
+            # within max_distance of the current one can hold matches
+            for edge, child in children.items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    pending.append(child)
+        return found
+
+
+_tree = None
+
+
+def add_tag(tag):
+    # The tag is read by the next catch up of the process anyway, this only
+    # saves other requests the wait. Names are only added once committed,
+    # so a rolled back tag never reaches the cached tree.
+    name = tag.name
+
+    def committed():
+        if _tree is not None:
+            _tree.add(name)
+
+    transaction.on_commit(committed)
+
+
+def tag_tree():
+    global _tree
+    if _tree is None:
+        _tree = cache.get(CACHE_KEY) or BKTree()
+    # Catch up with the tags created since the tree was built or cached,
+    # possibly by another process, and with the missing ids below the last
+    # one read
+    new_tags = list(models.Tag.objects.filter(
+        Q(id__gt=_tree.last_tag_id) |
+        Q(id__in=sorted(_tree.missing_ids))).order_by('id').values_list(
+            'id', 'name'))
+    if new_tags:
+        read = set()
+        for tag_id, tag_name in new_tags:
+            _tree.add(tag_name)
+            read.add(tag_id)
+        last_tag_id = max(_tree.last_tag_id, new_tags[-1][0])
+        _tree.missing_ids.update(range(
+            max(_tree.last_tag_id + 1, last_tag_id - GAP_WINDOW),
+            last_tag_id))
+        _tree.missing_ids = set(
+            tag_id for tag_id in _tree.missing_ids - read
+            if tag_id > last_tag_id - GAP_WINDOW)
+        _tree.last_tag_id = last_tag_id
+        cache.set(CACHE_KEY, _tree, None)
+    return _tree
+
+
+def near_tags(tag_names, max_distance):
+    tree = tag_tree()
+    near = set()
+    for tag_name in tag_names:
+        near |= tree.search(tag_name, max_distance)
+    return near
@@ -0,0 +1,50 @@
+from artifact_recommender import models
+from collections import defaultdict
+from decision_engine import settings
+from django.db.models import F
+import math
+
+# Inverse document frequency weights of the tags for the IDF weighted
+# similarity. The document frequency of each tag is kept in
+# Tag.artifact_count and updated on every link change, so weights are read
+# without counting links. Tags whose IDF is below SIMILARITY_MIN_IDF weigh
+# nothing, and are ignored when looking for candidates.
+
+
+def enabled():
+    return settings.SIMILARITY_WEIGHTING == 'idf'
+
+
+def weight(artifact_count, total):
+    idf = math.log((1.0 + total) / (1.0 + artifact_count))
+    return idf if idf >= settings.SIMILARITY_MIN_IDF else 0.0
+
+
+def artifact_total():
+    return models.Artifact.objects.count()
+
+
+def weights(tag_ids, total=None):
+    # {tag id: weight} of the tag_ids
+    if total is None:
+        total = artifact_total()
+    tag_ids = list(tag_ids)
+    counts = {}
+    for start in range(0, len(tag_ids), 500):
+        counts.update(models.Tag.objects.filter(
+            id__in=tag_ids[start:start + 500]).values_list(
+                'id', 'artifact_count'))
+    return {tag_id: weight(count, total) for tag_id, count in counts.items()}
+
+
+def count(tag_counts):
+    # Add the {tag id: change} link counts, with one update per distinct
+    # change
+    tag_ids = defaultdict(list)
+    for tag_id, change in tag_counts.items():
+        if change:
+            tag_ids[change].append(tag_id)
+    for change, ids in tag_ids.items():
+        for start in range(0, len(ids), 500):
+            models.Tag.objects.filter(id__in=ids[start:start + 500]).update(
+                artifact_count=F('artifact_count') + change)
@@ -0,0 +1,79 @@
+from artifact_recommender import idf, models, pending, recommender, tag_ids
+from artifact_recommender import tag_sets
+from collections import Counter, defaultdict
+from django.db import connection, transaction
+
+
+def stem(entries):
+    # Tags of every entry, stemmed once per distinct tag and language
+    tags = defaultdict(set)
+    for entry in entries:
+        tags[entry['lang']].update(entry['tags'])
+    stems = {}
+    for lang, names in tags.items():
+        names = list(names)
+        stems[lang] = dict(zip(names, recommender.stem_tags(lang, names)))
+    return [list(dict.fromkeys(stems[entry['lang']][name]
+                               for name in entry['tags']))
+            for entry in entries]
+
+
+def insert_children(model, entries):
+    # Multi-table children can not be bulk created, so their rows are
+    # inserted directly below the already created Artifact rows
+    fields = [model._meta.get_field('artifact_ptr')] + [
+        field for field in model._meta.local_concrete_fields
+        if field.name != 'artifact_ptr']
+    rows = [[field.get_db_prep_save(
+                entry['id'] if field.name == 'artifact_ptr' else
+                entry.get(field.name, field.get_default()), connection)
+             for field in fields]
+            for entry in entries]
+    with connection.cursor() as cursor:
+        cursor.executemany('INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(field.column)
+                      for field in fields),
+            ', '.join(['%s'] * len(fields))), rows)
+
+
+def import_artifacts(model, entries):
+    # Creates the artifacts of the validated entries whose id is free and
+    # schedules their similarities at once. Returns the created and
+    # the skipped ids.
+    taken = set()
+    for ids in recommender.chunks(entry['id'] for entry in entries):
+        taken.update(models.Artifact.objects.filter(pk__in=ids).values_list(
+            'pk', flat=True))
+    created = []
+    skipped = []
+    for entry in entries:
+        if entry['id'] in taken:
+            skipped.append(entry['id'])
+        else:
+            taken.add(entry['id'])
+            created.append(entry)
+    if not created:
+        return [], skipped
+
+    stemmed_tags = stem(created)
+    through = models.Artifact.tags.through
+    with transaction.atomic():
+        ids = tag_ids.resolve([name for names in stemmed_tags
+                               for name in names])
+        models.Artifact.objects.bulk_create(
+            models.Artifact(id=entry['id'], lang=entry['lang'])
+            for entry in created)
+        insert_children(model, created)
+        through.objects.bulk_create(
+            through(artifact_id=entry['id'], tag_id=ids[name])
+            for entry, names in zip(created, stemmed_tags)
+            for name in names)
+        idf.count(Counter(ids[name] for names in stemmed_tags
+                          for name in names))
+    created_ids = [entry['id'] for entry in created]
+    # Bulk created links send no m2m signal, their document frequencies are
+    # counted above
+    tag_sets.invalidate(created_ids)
+    pending.schedule(created_ids)
+    return created_ids, skipped
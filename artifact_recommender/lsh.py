@@ -0,0 +1,116 @@
+from artifact_recommender import models
+from decision_engine import settings
+from django.db import transaction
+from django.db.models import Q
+from functools import reduce
+import operator
+import random
+import zlib
+
+# Mersenne prime larger than any 32 bit tag hash
+PRIME = (1 << 61) - 1
+SEED = 2017
+
+
+_hash_functions = {}
+
+
+def hash_functions():
+    count = settings.MINHASH_PERMUTATIONS
+    if count not in _hash_functions:
+        generator = random.Random(SEED)
+        _hash_functions[count] = [(generator.randrange(1, PRIME),
+                                   generator.randrange(0, PRIME))
+                                  for _ in range(count)]
+    return _hash_functions[count]
+
+
+def minhash_signature(tag_names):
+    hashes = [zlib.crc32(name.encode('utf-8')) for name in tag_names]
+    if not hashes:
+        return []
+    return [min((a * x + b) % PRIME for x in hashes)
+            for a, b in hash_functions()]
+
+
+def lsh_buckets(signature):
+    # Artifacts without tags have no signature, and collide with nothing
+    if not signature:
+        return []
+    rows = len(signature) // settings.LSH_BANDS
+    buckets = []
+    for band in range(settings.LSH_BANDS):
+        band_values = signature[band * rows:(band + 1) * rows]
+        buckets.append(
+            (band, zlib.crc32(','.join(map(str, band_values)).encode())))
+    return buckets
+
+
+def estimated_similarity(signature, other_signature):
+    if not signature or len(signature) != len(other_signature):
+        return 0
+    matches = sum(1 for a, b in zip(signature, other_signature) if a == b)
+    return matches * 1.0 / len(signature)
+
+
+def update_signature(artifact_id, tag_names):
+    signature = minhash_signature(tag_names)
+    with transaction.atomic():
+        models.MinHash.objects.update_or_create(
+            artifact_id=artifact_id,
+            defaults={'signature': ','.join(map(str, signature))})
+        models.LSHBucket.objects.filter(artifact_id=artifact_id).delete()
+        models.LSHBucket.objects.bulk_create(
+            [models.LSHBucket(artifact_id=artifact_id, band=band,
+                              bucket=bucket)
+             for band, bucket in lsh_buckets(signature)])
+    return signature
+
+
+def rebuild_signatures(artifact_tags, batch_size=None):
+    # Replace every MinHash and LSHBucket row with those of the (artifact id,
+    # tag names) pairs, so turning SIMILARITY_LSH on finds the candidates of
+    # the whole catalogue. Returns the number of signatures.
+    count = 0
+    with transaction.atomic():
+        models.LSHBucket.objects.all().delete()
+        models.MinHash.objects.all().delete()
+        minhashes, buckets = [], []
+        for artifact_id, tag_names in artifact_tags:
+            signature = minhash_signature(tag_names)
+            minhashes.append(models.MinHash(
+                artifact_id=artifact_id,
+                signature=','.join(map(str, signature))))
+            buckets.extend(models.LSHBucket(artifact_id=artifact_id,
+                                            band=band, bucket=bucket)
+                           for band, bucket in lsh_buckets(signature))
+            if len(minhashes) == 1000:
+                _write_signatures(minhashes, buckets, batch_size)
+                count += len(minhashes)
+                minhashes, buckets = [], []
+        _write_signatures(minhashes, buckets, batch_size)
+    return count + len(minhashes)
+
+
+def _write_signatures(minhashes, buckets, batch_size):
+    models.MinHash.objects.bulk_create(minhashes, batch_size=batch_size)
+    models.LSHBucket.objects.bulk_create(buckets, batch_size=batch_size)
+
+
+def candidates(artifact_id, tag_names):
+    # Artifacts sharing at least one LSH bucket with the source whose
+    # estimated Jaccard reaches LSH_THRESHOLD
+    signature = update_signature(artifact_id, tag_names)
+    if not signature:
+        return set()
+    buckets = reduce(operator.or_,
+                     [Q(band=band, bucket=bucket)
+                      for band, bucket in lsh_buckets(signature)])
+    colliding = models.LSHBucket.objects.filter(buckets).exclude(
+        artifact_id=artifact_id).values('artifact_id')
+    similar = set()
+    for minhash in models.MinHash.objects.filter(artifact_id__in=colliding):
+        estimate = estimated_similarity(signature, minhash.signature_values)
+        if estimate >= settings.LSH_THRESHOLD:
+            similar.add(minhash.artifact_id)
+    return similar
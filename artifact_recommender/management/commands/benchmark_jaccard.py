@@ -0,0 +1,51 @@
+from array import array
+from artifact_recommender import recommender
+from django.core.management.base import BaseCommand
+import numpy as np
+import time
+
+
+class Command(BaseCommand):
+    help = ('Compare the set based tags_similarity with the jaccard_block '
+            'kernel on synthetic tag id arrays')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[1000, 10000, 100000],
+                            help='Candidates scored against the source in '
+                                 'each run')
+        parser.add_argument('--tags', type=int, default=8,
+                            help='Tags of each artifact')
+        parser.add_argument('--vocabulary', type=int, default=200,
+                            help='Distinct tags the artifacts draw from')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        random = np.random.RandomState(options['seed'])
+        tags = min(options['tags'], options['vocabulary'])
+
+        def tag_ids():
+            return array('i', sorted(random.choice(
+                options['vocabulary'], tags, replace=False).tolist()))
+
+        source = tag_ids()
+        for size in options['sizes']:
+            targets = [tag_ids() for _ in range(size)]
+            self.compare(size, source, targets)
+
+    def compare(self, size, source, targets):
+        # The set based function needs a set per comparison, as its callers
+        # used to build
+        started = time.time()
+        source_tags = set(source)
+        slow = [recommender.tags_similarity(source_tags, set(target))
+                for target in targets]
+        slow_seconds = time.time() - started
+        started = time.time()
+        fast = recommender.jaccard_block(source, targets).tolist()
+        fast_seconds = time.time() - started
+        self.stdout.write(
+            '{} candidates: sets {:.3f}s, kernel {:.3f}s ({:.1f}x), '
+            '{} scores'.format(size, slow_seconds, fast_seconds,
+                               slow_seconds / max(fast_seconds, 1e-6),
+                               'identical' if slow == fast else 'DIFFERENT'))
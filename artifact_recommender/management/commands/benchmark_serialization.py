@@ -0,0 +1,67 @@
+from artifact_recommender import models, serializers
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+from rest_framework.renderers import JSONRenderer
+import time
+
+
+class Command(BaseCommand):
+    help = ('Compare the dataset serializer with the values() fast path on '
+            'synthetic datasets, which are rolled back afterwards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+',
+                            default=[10000, 100000],
+                            help='Datasets listed in each run')
+        parser.add_argument('--tags', type=int, default=5,
+                            help='Tags of each dataset')
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            with transaction.atomic():
+                first_id = self.populate(size, options['tags'])
+                self.compare(size, models.Dataset.objects.filter(
+                    pk__gte=first_id).order_by('pk'))
+                transaction.set_rollback(True)
+
+    def populate(self, size, tag_count):
+        first_id = (models.Artifact.objects.aggregate(
+            last_id=Max('id'))['last_id'] or 0) + 1
+        ids = range(first_id, first_id + size)
+        tags = models.Tag.objects.bulk_create(
+            models.Tag(name='benchmark-{}'.format(i)) for i in range(100))
+        if tags[0].id is None:
+            tags = list(models.Tag.objects.filter(
+                name__startswith='benchmark-').order_by('id'))
+        models.Artifact.objects.bulk_create(
+            models.Artifact(id=artifact_id, lang='english')
+            for artifact_id in ids)
+        # Multi-table children can not be bulk created
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                'INSERT INTO {} (artifact_ptr_id) VALUES (%s)'.format(
+                    models.Dataset._meta.db_table),
+                [(artifact_id,) for artifact_id in ids])
+        through = models.Artifact.tags.through
+        through.objects.bulk_create(
+            through(artifact_id=artifact_id,
+                    tag_id=tags[(artifact_id + i) % len(tags)].id)
+            for artifact_id in ids for i in range(tag_count))
+        return first_id
+
+    def compare(self, size, queryset):
+        renderer = JSONRenderer()
+        started = time.time()
+        slow = renderer.render(serializers.DatasetSerializer(
+            queryset.prefetch_related('tags'), many=True).data)
+        slow_seconds = time.time() - started
+        started = time.time()
+        fast = renderer.render(serializers.artifact_rows(
+            queryset, serializers.DatasetSerializer))
+        fast_seconds = time.time() - started
+        self.stdout.write(
+            '{} datasets: serializer {:.2f}s, fast path {:.2f}s ({:.1f}x), '
+            '{} output'.format(size, slow_seconds, fast_seconds,
+                               slow_seconds / max(fast_seconds, 1e-6),
+                               'identical' if slow == fast else 'DIFFERENT'))
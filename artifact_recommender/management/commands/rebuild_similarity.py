@@ -0,0 +1,125 @@
+from artifact_recommender import lsh, models, neighbours
+from artifact_recommender.matrix import IncidenceMatrix
+from concurrent.futures import ProcessPoolExecutor
+from decision_engine import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, connections, transaction
+from io import StringIO
+import numpy as np
+import time
+
+# Shared with the forked workers, which inherit them copy-on-write
+_matrix = None
+_kth = None
+
+
+def _kth_shard(start, stop, k):
+    return _matrix.kth_values(start, stop, k)
+
+
+def _write_shard(start, stop, threshold, batch_size):
+    started = time.time()
+    similarities = list(_matrix.similarities(start, stop, threshold, _kth))
+    # Every pair is stored with its lowest id as source, so the rows of the
+    # shard are exactly those whose source lies in its id range
+    with transaction.atomic():
+        models.Similarity.objects.filter(
+            source_artifact_id__gte=_matrix.artifact_ids[start],
+            source_artifact_id__lte=_matrix.artifact_ids[stop - 1]).delete()
+        if connection.vendor == 'postgresql':
+            _copy_similarities(similarities)
+        else:
+            models.Similarity.objects.bulk_create(similarities,
+                                                  batch_size=batch_size)
+    return start, stop, len(similarities), time.time() - started
+
+
+def _copy_similarities(similarities):
+    meta = models.Similarity._meta
+    fields = [meta.get_field(name) for name in (
+        'source_artifact', 'target_artifact', 'source_type', 'target_type',
+        'value')]
+    rows = StringIO(''.join(
+        '\t'.join(str(getattr(similarity, field.attname))
+                  for field in fields) + '\n'
+        for similarity in similarities))
+    with connection.cursor() as cursor:
+        cursor.copy_from(rows, meta.db_table,
+                         columns=[field.column for field in fields])
+
+
+class Command(BaseCommand):
+    help = 'Recompute the whole Similarity table from the artifact tags'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes computing and writing shards')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Artifacts per shard')
+        parser.add_argument('--threshold', type=float,
+                            default=settings.SIMILARITY_MIN_VALUE,
+                            help='Only store similarities above this value')
+        parser.add_argument('--top-k', type=int,
+                            default=settings.SIMILARITY_TOP_K,
+                            help='Only store the k most similar artifacts '
+                                 'of each type of each artifact, 0 to '
+                                 'store them all')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Similarity rows per INSERT, by default '
+                                 'the most the database backend allows')
+        parser.add_argument('--signatures', action='store_true',
+                            help='Also rewrite the MinHash signatures and '
+                                 'LSH buckets of every artifact, as done '
+                                 'whenever SIMILARITY_LSH is on')
+
+    def handle(self, *args, **options):
+        global _matrix, _kth
+        started = time.time()
+        _matrix = IncidenceMatrix()
+        _kth = None
+        chunk_size = options['chunk_size']
+        shards = [(start, min(start + chunk_size, len(_matrix)))
+                  for start in range(0, len(_matrix), chunk_size)]
+        self.stdout.write('Loaded {} artifacts in {:.2f}s'.format(
+            len(_matrix), time.time() - started))
+
+        try:
+            if options['top_k']:
+                _kth = np.concatenate(list(
+                    self.map(_kth_shard, options['workers'],
+                             [shard + (options['top_k'],)
+                              for shard in shards])) or
+                    [np.zeros((0, _matrix.type_count))])
+            count = 0
+            for start, stop, shard_count, seconds in self.map(
+                    _write_shard, options['workers'],
+                    [shard + (options['threshold'], options['batch_size'])
+                     for shard in shards]):
+                count += shard_count
+                self.stdout.write(
+                    'Shard {}-{}: {} similarities in {:.2f}s'.format(
+                        start, stop, shard_count, seconds))
+            if options['signatures'] or settings.SIMILARITY_LSH:
+                signatures_started = time.time()
+                signatures = lsh.rebuild_signatures(
+                    zip(_matrix.artifact_ids.tolist(), _matrix.tags),
+                    options['batch_size'])
+                self.stdout.write('Stored {} signatures in {:.2f}s'.format(
+                    signatures, time.time() - signatures_started))
+        finally:
+            _matrix = _kth = None
+        neighbours.clear()
+        self.stdout.write(self.style.SUCCESS(
+            'Stored {} similarities in {:.2f}s'.format(
+                count, time.time() - started)))
+
+    def map(self, function, workers, arguments):
+        if workers <= 1 or not arguments:
+            for args in arguments:
+                yield function(*args)
+            return
+        # Forked workers must open their own database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(function, *zip(*arguments)):
+                yield result
@@ -0,0 +1,129 @@
+from artifact_recommender import fuzzy
+from artifact_recommender import idf
+from artifact_recommender import models
+from artifact_recommender.recommender import artifact_types
+from artifact_recommender.recommender import canonical_similarity
+from artifact_recommender.recommender import tags_similarity
+from decision_engine import settings
+from nltk.stem import snowball
+from scipy import sparse
+import numpy as np
+
+
+class IncidenceMatrix(object):
+    # Binary artifact x tag matrix, rows sorted by artifact id and columns
+    # holding distinct tag names. With IDF weighting the rows are scored
+    # against it through a copy holding the weight of each tag.
+
+    def __init__(self):
+        self.artifact_ids = np.array(sorted(
+            models.Artifact.objects.values_list('id', flat=True)),
+            dtype=np.int64)
+        self.langs = dict(models.Artifact.objects.values_list('id', 'lang'))
+        self.types = artifact_types(self.artifact_ids.tolist())
+        # Type of each row as an index into type_names, so the top k of each
+        # target type are cut apart as prune_similarities does
+        self.type_names = sorted(set(self.types.values()))
+        type_index = {name: i for i, name in enumerate(self.type_names)}
+        self.type_codes = np.array(
+            [type_index.get(self.types.get(artifact_id), len(type_index))
+             for artifact_id in self.artifact_ids.tolist()], dtype=np.int64)
+        # Untyped rows get a code of their own
+        self.type_count = len(type_index) + 1
+        row_of = {artifact_id: row
+                  for row, artifact_id in enumerate(self.artifact_ids)}
+        self.weights = None
+        if idf.enabled():
+            self.weights = {
+                name: idf.weight(count, len(self.artifact_ids))
+                for name, count in models.Tag.objects.values_list(
+                    'name', 'artifact_count')}
+        column_of = {}
+        self.tags = [set() for _ in self.artifact_ids]
+        rows, columns = [], []
+        links = models.Artifact.tags.through.objects.values_list(
+            'artifact_id', 'tag__name')
+        for artifact_id, tag_name in links.iterator():
+            row = row_of[artifact_id]
+            if tag_name in self.tags[row]:
+                continue
+            self.tags[row].add(tag_name)
+            # Tags weighing nothing can not make a pair similar
+            if self.weights is not None and not self.weights[tag_name]:
+                continue
+            rows.append(row)
+            columns.append(column_of.setdefault(tag_name, len(column_of)))
+        shape = (len(self.artifact_ids), len(column_of))
+        self.matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, columns)),
+            shape=shape)
+        self.weighted = self.matrix
+        if self.weights is not None:
+            names = sorted(column_of, key=column_of.get)
+            column_weights = np.array([self.weights[name] for name in names])
+            self.weighted = sparse.csr_matrix(
+                (column_weights[columns], (rows, columns)), shape=shape)
+        self.transposed = self.matrix.T.tocsr()
+        self.sizes = np.asarray(self.weighted.sum(axis=1),
+                                dtype=np.float64).ravel()
+
+    def __len__(self):
+        return len(self.artifact_ids)
+
+    def jaccard(self, start, stop):
+        # All non-zero similarities of rows [start, stop) as (rows, columns,
+        # values) arrays, excluding each artifact with itself
+        intersections = (self.weighted[start:stop] * self.transposed).tocoo()
+        rows = intersections.row.astype(np.int64) + start
+        columns = intersections.col.astype(np.int64)
+        shared = intersections.data.astype(np.float64)
+        values = shared / (self.sizes[rows] + self.sizes[columns] - shared)
+        mask = rows != columns
+        rows, columns, values = rows[mask], columns[mask], values[mask]
+        self._rescore_fuzzy(rows, columns, values)
+        return rows, columns, values
+
+    def _rescore_fuzzy(self, rows, columns, values):
+        # Sources without a Snowball stemmer compare their tags against the
+        # target tags close to them, as recommender.batch_similarities does
+        languages = snowball.SnowballStemmer.languages
+        near = {}
+        for i, (row, column) in enumerate(zip(rows, columns)):
+            if self.langs[self.artifact_ids[row]] in languages:
+                continue
+            if row not in near:
+                near[row] = fuzzy.near_tags(self.tags[row],
+                                            settings.MAX_LEVENSHTEIN)
+            values[i] = tags_similarity(self.tags[row],
+                                        self.tags[column] & near[row],
+                                        self.weights)
+
+    def kth_values(self, start, stop, k):
+        # k-th highest similarity of each row in [start, stop) among the
+        # artifacts of each type, as a (rows, type codes) array, 0 where a
+        # row has less than k similar artifacts of the type
+        rows, columns, values = self.jaccard(start, stop)
+        kth = np.zeros((stop - start) * self.type_count)
+        groups = (rows - start) * self.type_count + self.type_codes[columns]
+        order = np.lexsort((-values, groups))
+        groups, values = groups[order], values[order]
+        ranks = np.arange(len(groups)) - np.searchsorted(groups, groups)
+        selected = ranks == k - 1
+        kth[groups[selected]] = values[selected]
+        return kth.reshape(stop - start, self.type_count)
+
+    def similarities(self, start, stop, threshold=0, kth=None):
+        # Similarity of every pair stored once, with the lowest id as source,
+        # whose value exceeds threshold and, given the k-th values of all
+        # rows, is among the top k of its type of either artifact
+        rows, columns, values = self.jaccard(start, stop)
+        mask = (columns > rows) & (values > threshold)
+        if kth is not None:
+            mask &= ((values >= kth[rows, self.type_codes[columns]]) |
+                     (values >= kth[columns, self.type_codes[rows]]))
+        for source_id, target_id, value in zip(
+                self.artifact_ids[rows[mask]].tolist(),
+                self.artifact_ids[columns[mask]].tolist(),
+                values[mask].tolist()):
+            yield canonical_similarity(source_id, target_id, value,
+                                       self.types)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 03:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('artifact_recommender', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LSHBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('band', models.SmallIntegerField()),
+                ('bucket', models.BigIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MinHash',
+            fields=[
+                ('artifact', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='artifact_recommender.Artifact')),
+                ('signature', models.TextField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='tag',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='lshbucket',
+            name='artifact',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='artifact_recommender.Artifact'),
+        ),
+        migrations.AlterIndexTogether(
+            name='lshbucket',
+            index_together=set([('band', 'bucket')]),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 04:04
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import F
+
+
+def canonical_similarities(apps, schema_editor):
+    # Store every pair with the lowest artifact id as source, dropping the
+    # reversed duplicates of pairs already stored that way
+    Similarity = apps.get_model('artifact_recommender', 'Similarity')
+    reversed_similarities = Similarity.objects.filter(
+        source_artifact__gt=F('target_artifact'))
+    canonical = set(Similarity.objects.filter(
+        source_artifact__lt=F('target_artifact')).values_list(
+            'source_artifact', 'target_artifact'))
+    duplicates = [
+        similarity_id for similarity_id, source_id, target_id
+        in reversed_similarities.values_list(
+            'id', 'source_artifact', 'target_artifact').iterator()
+        if (target_id, source_id) in canonical]
+    for start in range(0, len(duplicates), 500):
+        Similarity.objects.filter(
+            id__in=duplicates[start:start + 500]).delete()
+    reversed_similarities.update(source_artifact=F('target_artifact'),
+                                 target_artifact=F('source_artifact'))
+
+
+# The pairs are rewritten apart from the indexes of 0004, as Postgres does
+# not create an index on a table with pending foreign key checks
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('artifact_recommender', '0002_minhash_lshbucket'),
+    ]
+
+    operations = [
+        migrations.RunPython(canonical_similarities,
+                             migrations.RunPython.noop),
+    ]
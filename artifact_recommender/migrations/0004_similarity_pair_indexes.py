@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 04:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('artifact_recommender', '0003_similarity_canonical_pairs'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='similarity',
+            index=models.Index(fields=['source_artifact', '-value'], name='artifact_re_source__d0db28_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='similarity',
+            index=models.Index(fields=['target_artifact', '-value'], name='artifact_re_target__4c657e_idx'),
+        ),
+    ]
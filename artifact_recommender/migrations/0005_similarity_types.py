@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 04:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+ARTIFACT_MODELS = (
+    ('dataset', 'Dataset'),
+    ('buildingblock', 'BuildingBlock'),
+    ('app', 'Application'),
+    ('idea', 'Idea'),
+)
+
+
+def similarity_types(apps, schema_editor):
+    Similarity = apps.get_model('artifact_recommender', 'Similarity')
+    for artifact_type, model_name in ARTIFACT_MODELS:
+        artifacts = apps.get_model('artifact_recommender',
+                                   model_name).objects.values('pk')
+        Similarity.objects.filter(source_artifact__in=artifacts).update(
+            source_type=artifact_type)
+        Similarity.objects.filter(target_artifact__in=artifacts).update(
+            target_type=artifact_type)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('artifact_recommender', '0004_similarity_pair_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='similarity',
+            name='source_type',
+            field=models.CharField(blank=True, choices=[('dataset', 'dataset'), ('buildingblock', 'buildingblock'), ('app', 'app'), ('idea', 'idea')], default='', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='similarity',
+            name='target_type',
+            field=models.CharField(blank=True, choices=[('dataset', 'dataset'), ('buildingblock', 'buildingblock'), ('app', 'app'), ('idea', 'idea')], default='', max_length=20),
+        ),
+        migrations.RunPython(similarity_types, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='similarity',
+            index=models.Index(fields=['source_artifact', 'target_type', '-value'], name='artifact_re_source__975ed6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='similarity',
+            index=models.Index(fields=['target_artifact', 'source_type', '-value'], name='artifact_re_target__f74dd3_idx'),
+        ),
+    ]
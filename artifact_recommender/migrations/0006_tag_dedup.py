@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 04:57
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from django.db import migrations
+from django.db.models import Count, Min
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError
+
+
+def dedup_tags(apps, schema_editor):
+    # Keep the oldest tag of every name and move the links of the others to
+    # it, dropping those that would link an artifact to it twice
+    Artifact = apps.get_model('artifact_recommender', 'Artifact')
+    Tag = apps.get_model('artifact_recommender', 'Tag')
+    Through = Artifact.tags.through
+    duplicates = list(Tag.objects.values('name').annotate(
+        keep=Min('id'), count=Count('id')).filter(count__gt=1))
+    for duplicate in duplicates:
+        others = Tag.objects.filter(name=duplicate['name']).exclude(
+            id=duplicate['keep'])
+        linked = set(Through.objects.filter(
+            tag_id=duplicate['keep']).values_list('artifact_id', flat=True))
+        for link in Through.objects.filter(tag__in=others).order_by('id'):
+            if link.artifact_id in linked:
+                link.delete()
+            else:
+                link.tag_id = duplicate['keep']
+                link.save()
+                linked.add(link.artifact_id)
+        others.delete()
+    if not duplicates:
+        return
+    # The cached ids of the dropped tags are stale
+    try:
+        cache.delete_many(['tag:{}'.format(duplicate['name'])
+                           for duplicate in duplicates])
+    except (ConnectionInterrupted, RedisError):
+        pass
+
+
+# The tags are merged apart from the constraint of 0007, as Postgres does
+# not alter a table with pending foreign key checks
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('artifact_recommender', '0005_similarity_types'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedup_tags, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from collections import defaultdict
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_artifacts(apps, schema_editor):
+    # One update per distinct document frequency
+    Artifact = apps.get_model('artifact_recommender', 'Artifact')
+    Tag = apps.get_model('artifact_recommender', 'Tag')
+    tags = defaultdict(list)
+    for link in Artifact.tags.through.objects.values('tag_id').annotate(
+            count=Count('id')):
+        tags[link['count']].append(link['tag_id'])
+    for count, tag_ids in tags.items():
+        for start in range(0, len(tag_ids), 500):
+            Tag.objects.filter(id__in=tag_ids[start:start + 500]).update(
+                artifact_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('artifact_recommender', '0007_tag_name_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tag',
+            name='artifact_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_artifacts, migrations.RunPython.noop),
+    ]
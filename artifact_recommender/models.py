@@ -5,7 +5,10 @@ from django.db import models
 
 class Tag(models.Model):
     name = models.CharField(max_length=100, null=False, blank=False,
-                            db_index=True)
+                            unique=True)
+    # Document frequency of the tag, maintained by the m2m signals for the
+    # IDF weighted similarity
+    artifact_count = models.IntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -37,18 +40,72 @@ class Idea(Artifact):
     pass
 
 
+# Artifact type names and the lookups of their child tables
+ARTIFACT_TYPES = (
+    ('dataset', 'dataset'),
+    ('buildingblock', 'buildingblock'),
+    ('app', 'application'),
+    ('idea', 'idea'),
+)
+
+
 class Similarity(models.Model):
+    TYPE_CHOICES = [(artifact_type, artifact_type)
+                    for artifact_type, _ in ARTIFACT_TYPES]
+
     source_artifact = models.ForeignKey('Artifact',
                                         related_name='source_artifact',
                                         on_delete=models.CASCADE)
     target_artifact = models.ForeignKey('Artifact',
                                         related_name='target_artifact',
                                         on_delete=models.CASCADE)
+    # Denormalised artifact types, so that type filtered neighbours are read
+    # without joining the artifact child tables
+    source_type = models.CharField(max_length=20, choices=TYPE_CHOICES,
+                                   blank=True, default='')
+    target_type = models.CharField(max_length=20, choices=TYPE_CHOICES,
+                                   blank=True, default='')
     value = models.FloatField(null=False)
 
+    # Each pair of artifacts is stored once, with the lowest id as source, so
+    # the neighbours of an artifact are read from one range scan per
+    # direction.
     class Meta:
         unique_together = (("source_artifact", "target_artifact"),)
+        indexes = [
+            models.Index(fields=['source_artifact', '-value']),
+            models.Index(fields=['target_artifact', '-value']),
+            models.Index(fields=['source_artifact', 'target_type', '-value']),
+            models.Index(fields=['target_artifact', 'source_type', '-value']),
+        ]
 
     def __str__(self):
         return '{} - {}: {}'.format(self.source_artifact.id,
                                     self.target_artifact.id, self.value)
+
+
+class MinHash(models.Model):
+    artifact = models.OneToOneField('Artifact', primary_key=True,
+                                    on_delete=models.CASCADE)
+    signature = models.TextField()
+
+    @property
+    def signature_values(self):
+        if not self.signature:
+            return []
+        return [int(value) for value in self.signature.split(',')]
+
+    def __str__(self):
+        return '{}: {}'.format(self.artifact_id, self.signature)
+
+
+class LSHBucket(models.Model):
+    artifact = models.ForeignKey('Artifact', on_delete=models.CASCADE)
+    band = models.SmallIntegerField()
+    bucket = models.BigIntegerField()
+
+    class Meta:
+        index_together = (("band", "bucket"),)
+
+    def __str__(self):
+        return '{} - {}: {}'.format(self.artifact_id, self.band, self.bucket)
@@ -0,0 +1,325 @@
+from artifact_recommender import models
+from collections import defaultdict
+from decision_engine import settings
+from django.db.models import F, Q
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError, WatchError
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ranked neighbour lists materialised as Redis sorted sets, one per artifact
+# and target type. Scores are the negated similarity values and members the
+# zero padded neighbour ids, so ZRANGE lists the most similar artifacts
+# first and breaks ties by ascending id.
+#
+# Lists are loaded from the database and stored from other processes than
+# those changing the similarities. Every invalidation increments a version
+# per artifact, and a list is only stored if the version of its artifact is
+# still the one read before loading it, so a list read before a change is
+# never stored after it. Lists also expire after NEIGHBOUR_CACHE_TTL
+# seconds.
+ALL_TYPES = 'artifact'
+TARGET_TYPES = [artifact_type
+                for artifact_type, _ in models.ARTIFACT_TYPES] + [ALL_TYPES]
+
+
+def key(artifact_id, target_type):
+    return 'recommend:{}:{}'.format(artifact_id, target_type)
+
+
+def keys(artifact_ids):
+    return [key(artifact_id, target_type)
+            for artifact_id in artifact_ids for target_type in TARGET_TYPES]
+
+
+def version_key(artifact_id):
+    return 'recommend-version:{}'.format(artifact_id)
+
+
+def redis_connection():
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def similarity_query(artifact_id, target_type, min_score=None, after=None):
+    # (neighbour id, value, neighbour type) rows, most similar first,
+    # optionally above min_score and after a (value, neighbour id) key.
+    # Pairs are stored once with the lowest id as source, so the neighbours
+    # are the union of one index range scan per direction
+    similarities = models.Similarity.objects
+    as_source = similarities.filter(source_artifact_id=artifact_id).annotate(
+        neighbour=F('target_artifact'), neighbour_type=F('target_type'))
+    as_target = similarities.filter(target_artifact_id=artifact_id).annotate(
+        neighbour=F('source_artifact'), neighbour_type=F('source_type'))
+    if target_type != ALL_TYPES:
+        as_source = as_source.filter(target_type=target_type)
+        as_target = as_target.filter(source_type=target_type)
+    if min_score is not None:
+        as_source = as_source.filter(value__gte=min_score)
+        as_target = as_target.filter(value__gte=min_score)
+    if after is not None:
+        value, neighbour_id = after
+        as_source = as_source.filter(
+            Q(value__lt=value) | Q(value=value,
+                                   target_artifact_id__gt=neighbour_id))
+        as_target = as_target.filter(
+            Q(value__lt=value) | Q(value=value,
+                                   source_artifact_id__gt=neighbour_id))
+    fields = ('neighbour', 'value', 'neighbour_type')
+    return as_source.values_list(*fields).union(
+        as_target.values_list(*fields), all=True).order_by(
+            '-value', 'neighbour')
+
+
+def neighbour_ids(artifact_id):
+    return set(neighbour_id for neighbour_id, _, _ in
+               similarity_query(artifact_id, ALL_TYPES))
+
+
+def _member(neighbour_id):
+    return '{:012d}'.format(neighbour_id)
+
+
+def _zadd(pipeline, name, neighbours):
+    members = []
+    for neighbour_id, value in neighbours:
+        members.extend([-value, _member(neighbour_id)])
+    if members:
+        pipeline.zadd(name, *members)
+
+
+def versions(artifact_ids):
+    # {artifact id: version} to read before loading the lists of the
+    # artifacts, None without Redis
+    connection = redis_connection()
+    if connection is None:
+        return None
+    artifact_ids = list(artifact_ids)
+    try:
+        return dict(zip(artifact_ids, connection.mget(
+            [version_key(artifact_id) for artifact_id in artifact_ids])))
+    except RedisError as e:
+        logger.warning('Can not read neighbour versions: {}'.format(e))
+        return None
+
+
+def store_many(lists, versions):
+    # lists: {(artifact id, target type): (neighbour id, value) pairs}
+    # loaded after reading the versions of their artifacts. Nothing is
+    # stored if any of them was invalidated meanwhile.
+    connection = redis_connection()
+    if connection is None or versions is None or not lists:
+        return
+    artifact_ids = list(versions)
+    names = [version_key(artifact_id) for artifact_id in artifact_ids]
+    try:
+        with connection.pipeline() as pipeline:
+            pipeline.watch(*names)
+            if pipeline.mget(names) != [versions[artifact_id]
+                                        for artifact_id in artifact_ids]:
+                return
+            pipeline.multi()
+            for (artifact_id, target_type), neighbours in lists.items():
+                name = key(artifact_id, target_type)
+                pipeline.delete(name)
+                _zadd(pipeline, name, neighbours)
+                pipeline.expire(name, settings.NEIGHBOUR_CACHE_TTL)
+            pipeline.execute()
+    except WatchError:
+        # Invalidated while storing, the lists may be stale
+        return
+    except RedisError as e:
+        logger.warning('Can not store neighbours of {}: {}'.format(
+            ', '.join(str(artifact_id) for artifact_id in artifact_ids), e))
+
+
+def cached(artifact_id, target_type, limit=None, offset=0, after=None,
+           min_score=None):
+    # A page of ranked (neighbour id, value) pairs, or None when the list is
+    # not materialised or the after key is no longer in it
+    connection = redis_connection()
+    if connection is None:
+        return None
+    name = key(artifact_id, target_type)
+    try:
+        start = offset
+        if after is not None:
+            value, neighbour_id = after
+            pipeline = connection.pipeline()
+            pipeline.zrank(name, _member(neighbour_id))
+            pipeline.zscore(name, _member(neighbour_id))
+            rank, score = pipeline.execute()
+            if rank is None or score != -value:
+                return None
+            start += rank + 1
+        stop = -1 if limit is None else start + limit - 1
+        pipeline = connection.pipeline()
+        pipeline.exists(name)
+        pipeline.zrange(name, start, stop, withscores=True)
+        exists, members = pipeline.execute()
+    except RedisError as e:
+        logger.warning('Can not read neighbours of {}: {}'.format(
+            artifact_id, e))
+        return None
+    if not exists:
+        return None
+    return [(int(member), -score) for member, score in members
+            if min_score is None or -score >= min_score]
+
+
+def paginate(neighbours, limit=None, offset=0, after=None, min_score=None):
+    # A page of the ranked (neighbour id, value) pairs, cut as
+    # similarity_query and then offset and limit would
+    if after is not None:
+        value, neighbour_id = after
+        neighbours = [neighbour for neighbour in neighbours
+                      if (-neighbour[1], neighbour[0]) > (-value,
+                                                          neighbour_id)]
+    if min_score is not None:
+        neighbours = [neighbour for neighbour in neighbours
+                      if neighbour[1] >= min_score]
+    return neighbours[offset:None if limit is None else offset + limit]
+
+
+def ranked(artifact_id, target_type, limit=None, offset=0, after=None,
+           min_score=None):
+    # A page of ranked (neighbour id, value) pairs, read from Redis when the
+    # list is materialised. Otherwise the whole list is loaded and stored
+    # once, so any page read repopulates it, and then cut. Without Redis the
+    # page is cut by the database.
+    page = cached(artifact_id, target_type, limit, offset, after, min_score)
+    if page is not None:
+        return page
+    read = versions([artifact_id])
+    if read is None:
+        rows = similarity_query(artifact_id, target_type, min_score, after)
+        if limit is not None:
+            rows = rows[offset:offset + limit]
+        elif offset:
+            rows = rows[offset:]
+        return [(neighbour_id, value) for neighbour_id, value, _ in rows]
+    neighbours = [(neighbour_id, value) for neighbour_id, value, _
+                  in similarity_query(artifact_id, target_type)]
+    store_many({(artifact_id, target_type): neighbours}, read)
+    return paginate(neighbours, limit, offset, after, min_score)
+
+
+def cached_many(pairs, limit=None):
+    # {(artifact id, target type): ranked (neighbour id, value) pairs} of the
+    # materialised lists, read in one pipeline
+    connection = redis_connection()
+    if connection is None or not pairs:
+        return {}
+    stop = -1 if limit is None else limit - 1
+    try:
+        pipeline = connection.pipeline()
+        for artifact_id, target_type in pairs:
+            pipeline.exists(key(artifact_id, target_type))
+            pipeline.zrange(key(artifact_id, target_type), 0, stop,
+                            withscores=True)
+        results = pipeline.execute()
+    except RedisError as e:
+        logger.warning('Can not read neighbours: {}'.format(e))
+        return {}
+    return {pair: [(int(member), -score) for member, score in members]
+            for pair, exists, members in zip(pairs, results[::2],
+                                             results[1::2])
+            if exists}
+
+
+def load_many(artifact_ids):
+    # {(artifact id, target type): ranked (neighbour id, value) pairs} of
+    # the artifacts, from one grouped query per 400 of them
+    artifact_ids = list(artifact_ids)
+    lists = defaultdict(list)
+    similarities = models.Similarity.objects
+    fields = ('artifact', 'neighbour', 'value', 'neighbour_type')
+    for start in range(0, len(artifact_ids), 400):
+        ids = artifact_ids[start:start + 400]
+        as_source = similarities.filter(source_artifact_id__in=ids).annotate(
+            artifact=F('source_artifact'), neighbour=F('target_artifact'),
+            neighbour_type=F('target_type'))
+        as_target = similarities.filter(target_artifact_id__in=ids).annotate(
+            artifact=F('target_artifact'), neighbour=F('source_artifact'),
+            neighbour_type=F('source_type'))
+        rows = as_source.values_list(*fields).union(
+            as_target.values_list(*fields), all=True)
+        for artifact_id, neighbour_id, value, neighbour_type in rows:
+            lists[(artifact_id, neighbour_type)].append((neighbour_id, value))
+            lists[(artifact_id, ALL_TYPES)].append((neighbour_id, value))
+    for neighbours in lists.values():
+        neighbours.sort(key=lambda neighbour: (-neighbour[1], neighbour[0]))
+    return lists
+
+
+def ranked_many(pairs, limit=None):
+    # Ranked (neighbour id, value) pairs of many (artifact id, target type)
+    # pairs: one Redis pipeline, then one grouped query for the misses
+    pairs = list(set(pairs))
+    found = cached_many(pairs, limit)
+    missing = [pair for pair in pairs if pair not in found]
+    artifact_ids = list(set(artifact_id for artifact_id, _ in missing))
+    read = versions(artifact_ids) if artifact_ids else None
+    lists = load_many(artifact_ids)
+    loaded = {pair: lists[pair] for pair in missing}
+    store_many({pair: neighbours for pair, neighbours in loaded.items()
+                if neighbours}, read)
+    for pair, neighbours in loaded.items():
+        found[pair] = neighbours if limit is None else neighbours[:limit]
+    return found
+
+
+def materialise(artifact_ids, affected_ids=()):
+    # Store every neighbour list of the artifacts and drop the lists of the
+    # affected ones, which are rebuilt on their next read
+    connection = redis_connection()
+    if connection is None:
+        return
+    artifact_ids = set(artifact_ids)
+    # Lists of the artifacts loaded before the change must not be stored
+    invalidate_many(artifact_ids | set(affected_ids))
+    read = versions(artifact_ids)
+    lists = load_many(artifact_ids)
+    store_many({(artifact_id, target_type): lists[(artifact_id, target_type)]
+                for artifact_id in artifact_ids
+                for target_type in TARGET_TYPES}, read)
+
+
+def invalidate(artifact_id):
+    if redis_connection() is None:
+        return
+    invalidate_many({artifact_id} | neighbour_ids(artifact_id))
+
+
+def invalidate_many(artifact_ids):
+    # Drop the lists of the artifacts, whose neighbours are already known,
+    # and increment their versions
+    connection = redis_connection()
+    if connection is None or not artifact_ids:
+        return
+    try:
+        pipeline = connection.pipeline()
+        pipeline.delete(*keys(artifact_ids))
+        for artifact_id in artifact_ids:
+            pipeline.incr(version_key(artifact_id))
+        pipeline.execute()
+    except RedisError as e:
+        logger.warning('Can not invalidate neighbours: {}'.format(e))
+
+
+def clear():
+    # Drop every materialised list, they are rebuilt on their next read. The
+    # versions are kept, so a list loaded meanwhile lasts NEIGHBOUR_CACHE_TTL
+    # seconds at most.
+    connection = redis_connection()
+    if connection is None:
+        return
+    try:
+        names = list(connection.scan_iter(match=key('*', '*'), count=1000))
+        for start in range(0, len(names), 1000):
+            connection.delete(*names[start:start + 1000])
+    except RedisError as e:
+        logger.warning('Can not clear neighbours: {}'.format(e))
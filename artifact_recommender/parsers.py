@@ -0,0 +1,19 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+import json
+
+
+class NDJSONParser(BaseParser):
+    # One JSON document per line, parsed into a list
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            return [json.loads(line)
+                    for line in stream.read().decode(encoding).splitlines()
+                    if line.strip()]
+        except ValueError as e:
+            raise ParseError('NDJSON parse error - {}'.format(e))
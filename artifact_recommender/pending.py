@@ -0,0 +1,65 @@
+from artifact_recommender import neighbours, recommender
+from decision_engine import settings
+from django.db import transaction
+from redis.exceptions import RedisError
+import django_rq
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Artifacts whose similarities must be recomputed are collected in a Redis
+# set and computed by a single drain job. The drain marker is set while a
+# drain job is queued, so the changes made before a worker picks it up only
+# add their ids to the set. The marker expires after SIMILARITY_DEBOUNCE
+# seconds in case the job is lost.
+PENDING_KEY = 'similarity:pending'
+DRAIN_KEY = 'similarity:drain'
+
+
+def schedule(artifact_ids):
+    # Recompute the similarities of the artifacts once the current
+    # transaction commits
+    artifact_ids = list(artifact_ids)
+    if artifact_ids:
+        transaction.on_commit(lambda: enqueue(artifact_ids))
+
+
+def enqueue(artifact_ids):
+    connection = neighbours.redis_connection()
+    if connection is not None:
+        try:
+            pipeline = connection.pipeline()
+            pipeline.sadd(PENDING_KEY, *artifact_ids)
+            pipeline.set(DRAIN_KEY, 1, nx=True,
+                         ex=settings.SIMILARITY_DEBOUNCE)
+            if pipeline.execute()[1]:
+                django_rq.enqueue(drain)
+            return
+        except RedisError:
+            logger.exception('Could not debounce similarity jobs')
+    django_rq.enqueue(recommender.tag_similarity_batch, artifact_ids)
+
+
+def drain():
+    # Recompute the pending artifacts in batches. The marker is deleted
+    # first, so ids added from now on enqueue a new drain job.
+    connection = neighbours.redis_connection()
+    connection.delete(DRAIN_KEY)
+    while True:
+        members = connection.srandmember(PENDING_KEY,
+                                         settings.SIMILARITY_DRAIN_SIZE)
+        if not members:
+            return
+        pipeline = connection.pipeline()
+        for member in members:
+            pipeline.srem(PENDING_KEY, member)
+        # Another drain job may have taken some of them
+        ids = [int(member) for member, removed
+               in zip(members, pipeline.execute()) if removed]
+        try:
+            recommender.tag_similarity_batch(sorted(ids))
+        except Exception:
+            # Left for a retry of the job or the next drain
+            if ids:
+                connection.sadd(PENDING_KEY, *ids)
+            raise
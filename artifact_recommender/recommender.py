@@ -1,14 +1,23 @@
 from nltk.stem import snowball
 from artifact_recommender import models
 from artifact_recommender import cdv
+from artifact_recommender import fuzzy
+from artifact_recommender import idf
+from artifact_recommender import lsh
+from artifact_recommender import neighbours
+from artifact_recommender import tag_ids
+from artifact_recommender import tag_sets
 from decision_engine import settings
 from geopy import geocoders
 from geopy.distance import vincenty
 from geopy.exc import GeocoderServiceError, GeocoderTimedOut
-from collections import Counter
+from collections import Counter, defaultdict
 from silk.profiling.profiler import silk_profile
 from django.core.cache import cache
-import Levenshtein
+from django.db import connection, transaction
+from django.db.models import Q
+from scipy import sparse
+import numpy as np
 import operator
 import logging
 
@@ -25,7 +34,14 @@ def stem_tags(lang, tags):
     return tags
 
 
-def tags_similarity(source_tags, target_tags):
+def tags_similarity(source_tags, target_tags, weights=None):
+    # Jaccard of the tag sets, weighting every tag by weights ({tag: weight})
+    # when given
+    if weights is not None:
+        union = sum(weights[tag] for tag in source_tags | target_tags)
+        if not union:
+            return 0
+        return sum(weights[tag] for tag in source_tags & target_tags) / union
     try:
         similarity = len(
             source_tags & target_tags) * 1.0 / len(
@@ -35,35 +51,369 @@ def tags_similarity(source_tags, target_tags):
     return similarity
 
 
+def jaccard_block(source_tag_ids, target_tag_ids, weights=None):
+    # Jaccard of the source tag id array with each of the target tag id
+    # arrays (array('i') or intc NumPy arrays), as one float64 array,
+    # weighting every tag by weights ({tag id: weight}) when given.
+    # Membership of every target tag is tested at once on their
+    # concatenation, and the shared tags are counted per target with one
+    # bincount.
+    source = np.asarray(source_tag_ids, dtype=np.intc)
+    lengths = np.fromiter(map(len, target_tag_ids), dtype=np.int64,
+                          count=len(target_tag_ids))
+    # The arrays hold C ints, so their buffers are joined without copying
+    # them one by one into NumPy
+    tags = np.frombuffer(b''.join(target_tag_ids), dtype=np.intc)
+    targets = np.repeat(np.arange(len(lengths)), lengths)
+    if weights is None:
+        shared = np.bincount(targets, weights=np.isin(tags, source),
+                             minlength=len(lengths))
+        union = len(source) + lengths - shared
+    else:
+        tag_weights = weight_array(tags, weights)
+        shared = np.bincount(
+            targets, weights=tag_weights * np.isin(tags, source),
+            minlength=len(lengths))
+        union = (weight_array(source, weights).sum() + np.bincount(
+            targets, weights=tag_weights, minlength=len(lengths)) - shared)
+    scores = np.zeros(len(lengths))
+    np.divide(shared, union, out=scores, where=union > 0)
+    return scores
+
+
+def weight_array(tags, weights):
+    # The weights ({tag id: weight}) of the tag id array
+    if not len(tags):
+        return np.zeros(0)
+    keys = np.array(sorted(weights), dtype=np.intc)
+    values = np.array([weights[key] for key in keys.tolist()])
+    return values[np.searchsorted(keys, tags)]
+
+
+def tag_names(tag_ids):
+    names = {}
+    for ids in chunks(tag_ids):
+        names.update(models.Tag.objects.filter(id__in=ids).values_list(
+            'id', 'name'))
+    return names
+
+
+def near_tag_ids(source_tag_ids, names):
+    # The ids of the {tag id: name} names close to those of the source tags,
+    # for the languages without a Snowball stemmer
+    near_tag_names = fuzzy.near_tags(
+        [names[tag_id] for tag_id in source_tag_ids],
+        settings.MAX_LEVENSHTEIN)
+    return set(tag_id for tag_id, name in names.items()
+               if name in near_tag_names)
+
+
 def tag_similarity(source_artifact_id):
-    source_artifact = models.Artifact.objects.get(pk=source_artifact_id)
-    similar_artifacts = {}
-    for target_artifact in models.Artifact.objects.all():
-        modified_tags = set()
-        if source_artifact.lang not in snowball.SnowballStemmer.languages:
-            for target_tag in target_artifact.tags.all():
-                for source_tag in source_artifact.tags.all():
-                    distance = Levenshtein.distance(target_tag.name,
-                                                    source_tag.name)
-                    if distance <= settings.MAX_LEVENSHTEIN:
-                        modified_tags.add(target_tag.name)
+    tag_similarity_batch([source_artifact_id])
+
+
+def tag_similarity_batch(source_artifact_ids):
+    # Same Similarity rows as scoring each source in turn, with every chunk
+    # of sources scored at once. Deleted artifacts are skipped.
+    source_artifact_ids = list(dict.fromkeys(source_artifact_ids))
+    for ids in chunks(source_artifact_ids, 400):
+        similar_artifacts = batch_similarities(ids)
+        save_batch_similarities(
+            [source_id for source_id in ids if source_id in similar_artifacts],
+            similar_artifacts)
+
+
+def jaccard_rows(rows, columns, source_rows, cell_weights=None):
+    # (source row, row, Jaccard) triples of the rows sharing a column with
+    # each source row, given the (row, column) cells of a binary matrix and
+    # optionally the weight of each cell, from one sparse product
+    if not source_rows:
+        return []
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, columns)))
+    weighted = matrix
+    if cell_weights is not None:
+        weighted = sparse.csr_matrix(
+            (np.array(cell_weights, dtype=np.float64), (rows, columns)))
+    sizes = np.asarray(weighted.sum(axis=1), dtype=np.float64).ravel()
+    source_rows = np.array(source_rows, dtype=np.int64)
+    intersections = (weighted[source_rows] * matrix.T).tocoo()
+    source_rows = source_rows[intersections.row]
+    shared = intersections.data.astype(np.float64)
+    values = shared / (sizes[source_rows] + sizes[intersections.col] -
+                       shared)
+    mask = source_rows != intersections.col
+    return zip(source_rows[mask].tolist(),
+               intersections.col[mask].tolist(), values[mask].tolist())
+
+
+def batch_similarities(source_artifact_ids):
+    # {source id: {artifact id: value}} of the existing sources. The tag sets
+    # of every artifact sharing a tag with a source, or with SIMILARITY_LSH
+    # of their LSH candidates only, are scored against all the sources at
+    # once.
+    langs = dict(models.Artifact.objects.filter(
+        pk__in=source_artifact_ids).values_list('id', 'lang'))
+    sets = tag_sets.lookup(langs)
+    source_tags = set().union(*sets.values())
+    weights = None
+    if idf.enabled():
+        total = idf.artifact_total()
+        weights = idf.weights(source_tags, total)
+    candidates = None
+    if settings.SIMILARITY_LSH:
+        # Only the LSH candidates of the sources are scored. Also stores the
+        # signatures of the sources.
+        source_names = tag_names(source_tags)
+        candidates = {source_id: lsh.candidates(source_id, set(
+            source_names[tag_id] for tag_id in sets[source_id]))
+            for source_id in langs}
+        neighbourhood = set().union(*candidates.values())
+    else:
+        if weights is not None:
+            source_tags = set(tag for tag in source_tags if weights[tag])
+        neighbourhood = set()
+        for ids in chunks(source_tags):
+            neighbourhood.update(models.Artifact.tags.through.objects.filter(
+                tag_id__in=ids).values_list('artifact_id', flat=True))
+    sets.update(tag_sets.lookup(neighbourhood - set(sets)))
+    if weights is not None:
+        weights.update(idf.weights(
+            set().union(*sets.values()) - set(weights), total))
+
+    row_of, rows, columns, cell_weights = {}, [], [], []
+    for artifact_id, tags in sets.items():
+        if weights is not None:
+            # Tags weighing nothing can not make a pair similar
+            tags = [tag for tag in tags if weights[tag]]
+            cell_weights.extend(weights[tag] for tag in tags)
+        if tags:
+            row = row_of.setdefault(artifact_id, len(row_of))
+            rows.extend([row] * len(tags))
+            columns.extend(tags)
+    similar_artifacts = {source_id: {} for source_id in langs}
+    sources = [source_id for source_id in source_artifact_ids
+               if source_id in langs and source_id in row_of]
+    names = None
+    if any(langs[source_id] not in snowball.SnowballStemmer.languages
+           for source_id in sources):
+        names = tag_names(set().union(*sets.values()))
+
+    artifact_ids = list(row_of)
+    fuzzy_targets = defaultdict(list)
+    for source_row, row, value in jaccard_rows(
+            rows, columns, [row_of[source_id] for source_id in sources],
+            cell_weights if weights is not None else None):
+        source_id = artifact_ids[source_row]
+        target_id = artifact_ids[row]
+        if candidates is not None and target_id not in candidates[source_id]:
+            continue
+        if langs[source_id] not in snowball.SnowballStemmer.languages:
+            fuzzy_targets[source_id].append(target_id)
+        elif value > 0:
+            similar_artifacts[source_id][target_id] = value
+    for source_id, target_ids in fuzzy_targets.items():
+        # Rescored against the target tags close to those of the source,
+        # every target of the source at once
+        near_tags = np.array(sorted(near_tag_ids(sets[source_id], names)),
+                             dtype=np.intc)
+        scores = jaccard_block(sets[source_id], [
+            np.intersect1d(sets[target_id], near_tags, assume_unique=True)
+            for target_id in target_ids], weights)
+        for target_id, value in zip(target_ids, scores.tolist()):
+            if value > 0:
+                similar_artifacts[source_id][target_id] = value
+    return similar_artifacts
+
+
+def save_batch_similarities(source_artifact_ids, similar_artifacts):
+    # Replace every Similarity involving the sources at once. As with
+    # successive save_similarities calls, a pair of two sources is kept by
+    # the last of them to be saved.
+    position = {source_id: i for i, source_id in
+                enumerate(source_artifact_ids)}
+    types = artifact_types(set(source_artifact_ids).union(*(
+        similar.keys() for similar in similar_artifacts.values())))
+    kept = kept_similarities({source_id: similar_artifacts[source_id]
+                              for source_id in source_artifact_ids}, types)
+    new_similarities = []
+    for source_id in source_artifact_ids:
+        for artifact_id, value in kept[source_id].items():
+            if position.get(artifact_id, -1) < position[source_id]:
+                new_similarities.append(canonical_similarity(
+                    source_id, artifact_id, value, types))
+    previous_pairs = write_similarities(models.Similarity.objects.filter(
+        Q(source_artifact_id__in=source_artifact_ids) |
+        Q(target_artifact_id__in=source_artifact_ids)), new_similarities)
+    affected = set(source_artifact_ids)
+    for similarity in new_similarities:
+        affected.update([similarity.source_artifact_id,
+                         similarity.target_artifact_id])
+    for pair in previous_pairs:
+        affected.update(pair)
+    # The lists of the sources are stored again, those of their current and
+    # previous neighbours are rebuilt on their next read
+    neighbours.materialise(source_artifact_ids, affected)
+
+
+def chunks(items, size=500):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def artifact_types(artifact_ids):
+    types = {}
+    lookups = [lookup for _, lookup in models.ARTIFACT_TYPES]
+    for ids in chunks(artifact_ids):
+        rows = models.Artifact.objects.filter(pk__in=ids).values_list(
+            'pk', *lookups)
+        for artifact_id, *children in rows:
+            for (artifact_type, _), child in zip(models.ARTIFACT_TYPES,
+                                                 children):
+                if child is not None:
+                    types[artifact_id] = artifact_type
+    return types
+
+
+def prune_similarities(similar_artifacts, types):
+    # Keep the SIMILARITY_TOP_K best artifacts of each type whose value
+    # exceeds SIMILARITY_MIN_VALUE
+    by_type = defaultdict(list)
+    for artifact_id, value in similar_artifacts.items():
+        if value > settings.SIMILARITY_MIN_VALUE:
+            by_type[types.get(artifact_id)].append((-value, artifact_id))
+    pruned = {}
+    for candidates in by_type.values():
+        candidates.sort()
+        for value, artifact_id in candidates[:settings.SIMILARITY_TOP_K]:
+            pruned[artifact_id] = -value
+    return dict(sorted(pruned.items()))
+
+
+def kept_similarities(similar_artifacts, types):
+    # The {source id: {artifact id: value}} similarities to store: those
+    # among the top SIMILARITY_TOP_K of the type of either artifact, as
+    # IncidenceMatrix.similarities keeps them, so recomputing a source does
+    # not take the best neighbours of artifacts whose tags did not change.
+    # The lists of the other artifacts are read from the stored
+    # similarities, which hold the top k of every artifact.
+    sources = set(similar_artifacts)
+    top = {source_id: prune_similarities(similar, types)
+           for source_id, similar in similar_artifacts.items()}
+    kept = {source_id: dict(pruned) for source_id, pruned in top.items()}
+    checks = []
+    for source_id, similar in similar_artifacts.items():
+        for artifact_id, value in similar.items():
+            if (artifact_id in top[source_id] or
+                    value <= settings.SIMILARITY_MIN_VALUE):
+                continue
+            if artifact_id in sources:
+                if source_id in top[artifact_id]:
+                    kept[source_id][artifact_id] = value
+            else:
+                checks.append((source_id, artifact_id, value))
+    if not checks:
+        return kept
+
+    # (artifact id, type) -> (value, id) of the artifacts of the type similar
+    # to the artifact, with the stored values of the sources replaced
+    others = defaultdict(list)
+    targets = set(artifact_id for _, artifact_id, _ in checks)
+    for source_id, similar in similar_artifacts.items():
+        for artifact_id, value in similar.items():
+            if artifact_id in targets:
+                others[(artifact_id, types.get(source_id, ''))].append(
+                    (value, source_id))
+    for ids in chunks(targets):
+        rows = models.Similarity.objects.filter(
+            Q(source_artifact_id__in=ids) | Q(target_artifact_id__in=ids))
+        for source_id, target_id, source_type, target_type, value in (
+                rows.values_list('source_artifact_id', 'target_artifact_id',
+                                 'source_type', 'target_type', 'value')):
+            if source_id in sources or target_id in sources:
+                continue
+            if source_id in targets:
+                others[(source_id, target_type)].append((value, target_id))
+            if target_id in targets:
+                others[(target_id, source_type)].append((value, source_id))
+    for source_id, artifact_id, value in checks:
+        # Ranked as prune_similarities does, ties by ascending id
+        better = sum(1 for other_value, other_id in others[(
+            artifact_id, types.get(source_id, ''))]
+            if (-other_value, other_id) < (-value, source_id))
+        if better < settings.SIMILARITY_TOP_K:
+            kept[source_id][artifact_id] = value
+    return kept
+
+
+def canonical_similarity(artifact_id, other_artifact_id, value, types):
+    # Each pair is stored once, with the lowest artifact id as source
+    source_id, target_id = sorted((artifact_id, other_artifact_id))
+    return models.Similarity(source_artifact_id=source_id,
+                             target_artifact_id=target_id,
+                             source_type=types.get(source_id, ''),
+                             target_type=types.get(target_id, ''),
+                             value=value)
+
+
+def save_similarities(source_artifact_id, similar_artifacts):
+    # Replace every Similarity involving the source with those of
+    # similar_artifacts ({artifact id: value}) worth storing
+    save_batch_similarities([source_artifact_id],
+                            {source_artifact_id: similar_artifacts})
+
+
+def write_similarities(similarities, new_similarities):
+    # Make the similarities queryset hold new_similarities, only writing
+    # the pairs that appeared, vanished or changed value, so retagging an
+    # artifact leaves its unaffected pairs alone. Returns the previous
+    # (source id, target id) pairs.
+    new = {(similarity.source_artifact_id, similarity.target_artifact_id):
+           similarity for similarity in new_similarities}
+    with transaction.atomic():
+        existing = {(source_id, target_id): (pk, value)
+                    for pk, source_id, target_id, value
+                    in similarities.values_list(
+                        'pk', 'source_artifact_id', 'target_artifact_id',
+                        'value')}
+        changed = [similarity for pair, similarity in new.items()
+                   if pair not in existing or
+                   existing[pair][1] != similarity.value]
+        if connection.vendor == 'postgresql':
+            stale = [pk for pair, (pk, _) in existing.items()
+                     if pair not in new]
         else:
-            for target_tag in target_artifact.tags.all():
-                modified_tags.add(target_tag.name)
-        source_tag_names = set()
-        for tag in source_artifact.tags.all():
-            source_tag_names.add(tag.name)
-        similarity = tags_similarity(source_tag_names, modified_tags)
-
-        if similarity > 0:
-            similar_artifacts[target_artifact] = similarity
-    for artifact in similar_artifacts:
-        if artifact.id != source_artifact.id:
-            sim_value = similar_artifacts[artifact]
-            similarity = models.Similarity(source_artifact=source_artifact,
-                                           target_artifact=artifact,
-                                           value=sim_value)
-            similarity.save()
+            stale = [pk for pair, (pk, value) in existing.items()
+                     if pair not in new or new[pair].value != value]
+        for ids in chunks(stale):
+            models.Similarity.objects.filter(pk__in=ids).delete()
+        if changed and connection.vendor == 'postgresql':
+            _upsert_similarities(changed)
+        elif changed:
+            models.Similarity.objects.bulk_create(changed)
+    return set(existing)
+
+
+def _upsert_similarities(similarities):
+    meta = models.Similarity._meta
+    fields = [meta.get_field(name) for name in (
+        'source_artifact', 'target_artifact', 'source_type', 'target_type',
+        'value')]
+    params = []
+    for similarity in similarities:
+        params.extend(getattr(similarity, field.attname) for field in fields)
+    sql = ('INSERT INTO {table} ({columns}) VALUES {rows} '
+           'ON CONFLICT ({source}, {target}) '
+           'DO UPDATE SET {value} = EXCLUDED.{value}').format(
+               table=meta.db_table,
+               columns=', '.join(field.column for field in fields),
+               source=fields[0].column, target=fields[1].column,
+               value=fields[-1].column,
+               rows=', '.join(['({})'.format(', '.join(['%s'] * len(fields)))]
+                              * len(similarities)))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
 
 
 def recommend_app(user_id, lat, lon, radius):
@@ -96,13 +446,16 @@ def recommend_app(user_id, lat, lon, radius):
         lon = user_loc.longitude
     user_point = (lat, lon)
 
+    used_apps = set(models.Application.objects.filter(
+        pk__in=user_apps).values_list('pk', flat=True))
+    used_apps_tag_ids = tag_sets.lookup(used_apps)
+    names = tag_names(set().union(*used_apps_tag_ids.values()))
     used_apps_tags = []
     for app_id in user_apps:
-        try:
-            app = models.Application.objects.get(pk=app_id)
-            for tag in app.tags.all():
-                used_apps_tags.append(tag.name)
-        except models.Application.DoesNotExist:
+        if app_id in used_apps:
+            for tag_id in used_apps_tag_ids[app_id]:
+                used_apps_tags.append(names[tag_id])
+        else:
             logger.error('Can not retrieve app {}'.format(app_id))
 
     ordered_used_tags = Counter(used_apps_tags)
@@ -125,15 +478,31 @@ def recommend_app(user_id, lat, lon, radius):
                            '{}'.format(app.scope))
 
     similar_apps = {}
+    app_tags = tag_sets.lookup(app.id for app in filtered_apps)
+    user_stemmed_tags = {}
+    weights = None
+    if idf.enabled():
+        total = idf.artifact_total()
+        weights = defaultdict(lambda: idf.weight(0, total))
+        weights.update(idf.weights(
+            set().union(*app_tags.values()), total))
     for app in filtered_apps:
         if len(user_tags) <= 0:
             similar_apps[app.id] = 1
         else:
-            app_tags = set()
-            for tag in app.tags.all():
-                app_tags.add(tag.name)
-            user_stemmed_tags = stem_tags(app.lang, user_tags)
-            similarity = tags_similarity(set(user_stemmed_tags), app_tags)
+            if app.lang not in user_stemmed_tags:
+                # Stemmed user tags which are not tags can not match any
+                # app, but still count in the union
+                stemmed_tags = stem_tags(app.lang, user_tags)
+                ids = tag_ids.lookup(stemmed_tags)
+                user_stemmed_tags[app.lang] = set(
+                    ids.get(tag, tag) for tag in stemmed_tags)
+                if weights is not None:
+                    # Unknown tags weigh as tags of no artifact
+                    weights.update(idf.weights(
+                        set(ids.values()) - set(weights), total))
+            similarity = tags_similarity(user_stemmed_tags[app.lang],
+                                         set(app_tags[app.id]), weights)
             if similarity > settings.RECOMENDATION_THRESHOLD:
                 similar_apps[app.id] = similarity
 
@@ -1,11 +1,48 @@
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
 from artifact_recommender.models import Dataset, Tag, BuildingBlock
-from artifact_recommender.models import Application, Idea
+from artifact_recommender.models import Application, Idea, Artifact
+from collections import defaultdict
+
+
+class TagNamesField(serializers.ManyRelatedField):
+    # Looks every tag up with one query instead of one query per name, or
+    # none when the view passes the {name: tag id} of tag_ids.resolve as the
+    # tag_ids context
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        slug_field = self.child_relation.slug_field
+        resolved = self.context.get('tag_ids')
+        try:
+            if resolved is not None:
+                return [resolved[name] for name in data]
+            tags = {getattr(tag, slug_field): tag
+                    for tag in self.child_relation.get_queryset().filter(
+                        **{slug_field + '__in': data})}
+            return [tags[name] for name in data]
+        except KeyError as e:
+            self.child_relation.fail('does_not_exist', slug_name=slug_field,
+                                     value=e.args[0])
+        except (TypeError, ValueError):
+            self.child_relation.fail('invalid')
+
+
+class TagSlugRelatedField(serializers.SlugRelatedField):
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return TagNamesField(**list_kwargs)
 
 
 class DatasetSerializer(serializers.ModelSerializer):
-    tags = serializers.SlugRelatedField(many=True, slug_field='name',
-                                        queryset=Tag.objects.all())
+    tags = TagSlugRelatedField(many=True, slug_field='name',
+                               queryset=Tag.objects.all())
 
     class Meta:
         model = Dataset
@@ -19,8 +56,8 @@ class TagSerializer(serializers.ModelSerializer):
 
 
 class BuildingBlockSerializer(serializers.ModelSerializer):
-    tags = serializers.SlugRelatedField(many=True, slug_field='name',
-                                        queryset=Tag.objects.all())
+    tags = TagSlugRelatedField(many=True, slug_field='name',
+                               queryset=Tag.objects.all())
 
     class Meta:
         model = BuildingBlock
@@ -28,8 +65,8 @@ class BuildingBlockSerializer(serializers.ModelSerializer):
 
 
 class ApplicationSerializer(serializers.ModelSerializer):
-    tags = serializers.SlugRelatedField(many=True, slug_field='name',
-                                        queryset=Tag.objects.all())
+    tags = TagSlugRelatedField(many=True, slug_field='name',
+                               queryset=Tag.objects.all())
 
     class Meta:
         model = Application
@@ -37,9 +74,43 @@ class ApplicationSerializer(serializers.ModelSerializer):
 
 
 class IdeaSerializer(serializers.ModelSerializer):
-    tags = serializers.SlugRelatedField(many=True, slug_field='name',
-                                        queryset=Tag.objects.all())
+    tags = TagSlugRelatedField(many=True, slug_field='name',
+                               queryset=Tag.objects.all())
 
     class Meta:
         model = Idea
         fields = ('id', 'lang', 'tags')
+
+
+def import_serializer(serializer_class):
+    # Validates bulk imported artifacts without touching the database: the
+    # importer skips the ids that are taken and creates the missing tags
+    class ImportSerializer(serializers.ModelSerializer):
+        id = serializers.IntegerField()
+        tags = serializers.ListField(
+            child=serializers.CharField(max_length=100))
+
+        class Meta(serializer_class.Meta):
+            pass
+
+    return ImportSerializer
+
+
+def artifact_rows(queryset, serializer_class):
+    # Read-only fast path for many=True: the same representation as the
+    # serializer, built from values() and one grouped tag query
+    fields = serializer_class.Meta.fields
+    columns = [field for field in fields if field != 'tags']
+    queryset = queryset.prefetch_related(None)
+    tags = defaultdict(list)
+    links = Artifact.tags.through.objects.filter(
+        artifact_id__in=queryset.values('pk')).order_by(
+            'artifact_id', 'tag_id').values_list('artifact_id', 'tag__name')
+    for artifact_id, name in links:
+        tags[artifact_id].append(name)
+    rows = []
+    for values in queryset.values_list(*columns):
+        row = dict(zip(columns, values))
+        rows.append({field: tags[row['id']] if field == 'tags' else row[field]
+                     for field in fields})
+    return rows
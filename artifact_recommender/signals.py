@@ -1,12 +1,80 @@
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_save, pre_delete
 from django.dispatch import receiver
-from artifact_recommender import models
-from artifact_recommender.recommender import tag_similarity
-import django_rq
+from artifact_recommender import fuzzy, idf, models, neighbours, pending
+from artifact_recommender import tag_ids, tag_sets
+from collections import Counter
 
 
 @receiver(m2m_changed, sender=models.Artifact.tags.through)
 def similarity_callback(sender, instance, signal, action, reverse, model,
                         pk_set, **kwargs):
-    if action == 'post_add':
-        django_rq.enqueue(tag_similarity, instance.id)
+    # Only the artifacts whose tags actually changed are recomputed. From
+    # the tag side (reverse) the instance is a tag and pk_set holds
+    # artifact ids.
+    if action == 'pre_remove':
+        # Removals send pk_set unfiltered, keep the links that exist
+        links = sender.objects.filter(**(
+            {'tag_id': instance.id, 'artifact_id__in': pk_set} if reverse
+            else {'artifact_id': instance.id, 'tag_id__in': pk_set}))
+        instance._removed_pk_set = set(links.values_list(
+            'artifact_id' if reverse else 'tag_id', flat=True))
+    elif action == 'post_remove':
+        pk_set = instance.__dict__.pop('_removed_pk_set', pk_set)
+    if action in ('post_add', 'post_remove') and pk_set:
+        change = 1 if action == 'post_add' else -1
+        if reverse:
+            idf.count({instance.id: change * len(pk_set)})
+            tags_changed(sorted(pk_set))
+        else:
+            idf.count({tag_id: change for tag_id in pk_set})
+            tags_changed([instance.id])
+    elif action == 'pre_clear':
+        # Clears send no pk_set, so the cleared links are kept for
+        # post_clear
+        links = sender.objects.filter(
+            **{'tag_id' if reverse else 'artifact_id': instance.id})
+        instance._cleared_links = list(links.values_list('artifact_id',
+                                                         'tag_id'))
+    elif action == 'post_clear':
+        links = instance.__dict__.pop('_cleared_links', [])
+        if links:
+            links_removed(links)
+            tags_changed(sorted(set(artifact_id
+                                    for artifact_id, _ in links)))
+
+
+def links_removed(links):
+    # (artifact id, tag id) links deleted without their own m2m signal
+    removed = Counter(tag_id for _, tag_id in links)
+    idf.count({tag_id: -count for tag_id, count in removed.items()})
+
+
+def tags_changed(artifact_ids):
+    tag_sets.invalidate(artifact_ids)
+    pending.schedule(artifact_ids)
+
+
+@receiver(post_save, sender=models.Tag)
+def fuzzy_tag_callback(sender, instance, created, **kwargs):
+    if created:
+        fuzzy.add_tag(instance)
+        tag_ids.store({instance.name: instance.id})
+
+
+@receiver(pre_delete, sender=models.Tag)
+def tag_delete_callback(sender, instance, **kwargs):
+    # Deleting a tag cascades to its links without any m2m_changed signal
+    tag_ids.forget([instance.name])
+    artifact_ids = list(models.Artifact.tags.through.objects.filter(
+        tag_id=instance.id).values_list('artifact_id', flat=True))
+    if artifact_ids:
+        tags_changed(artifact_ids)
+
+
+@receiver(pre_delete, sender=models.Artifact)
+def neighbours_callback(sender, instance, **kwargs):
+    neighbours.invalidate(instance.id)
+    tag_sets.invalidate([instance.id])
+    # The links of the artifact are deleted by the cascade
+    links_removed(models.Artifact.tags.through.objects.filter(
+        artifact_id=instance.id).values_list('artifact_id', 'tag_id'))
@@ -0,0 +1,139 @@
+from artifact_recommender import fuzzy, models
+from collections import OrderedDict
+from decision_engine import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+import uuid
+
+# In-process LRU map of tag name -> id in front of the tag:<name> cache keys.
+# Names are unique and tags are never renamed, so pairs are only stored once
+# committed. An entry goes stale when its tag is deleted, which drops its
+# key and stores a new epoch token, so every process whose map was filled
+# under another epoch drops it, or when its id is reused by a new tag,
+# which evicts it.
+EPOCH_KEY = 'tags:epoch'
+_ids = OrderedDict()
+_names = {}
+_epoch = None
+
+
+def cache_key(name):
+    return 'tag:{}'.format(name)
+
+
+def remember(name, tag_id):
+    stale_name = _names.get(tag_id)
+    if stale_name is not None and stale_name != name:
+        del _ids[stale_name]
+    if name in _ids:
+        del _names[_ids[name]]
+    _ids[name] = tag_id
+    _ids.move_to_end(name)
+    _names[tag_id] = name
+    while len(_ids) > settings.TAG_ID_CACHE_SIZE:
+        _, evicted_id = _ids.popitem(last=False)
+        del _names[evicted_id]
+
+
+def store(ids):
+    # Remember the {name: tag id} pairs and cache them once committed, as a
+    # rolled back tag must not be found again, unless a tag was deleted
+    # meanwhile
+    ids = dict(ids)
+    epoch = _epoch
+
+    def committed():
+        if cache.get(EPOCH_KEY) != epoch:
+            return
+        cache.set_many({cache_key(name): tag_id
+                        for name, tag_id in ids.items()})
+        for name, tag_id in ids.items():
+            remember(name, tag_id)
+
+    if ids:
+        transaction.on_commit(committed)
+
+
+def forget(names):
+    # Forget deleted tags now, as the current transaction reads its own
+    # changes, and everywhere once committed
+    names = list(names)
+
+    def committed():
+        evict()
+        cache.delete_many([cache_key(name) for name in names])
+        cache.set(EPOCH_KEY, uuid.uuid4().hex, None)
+
+    def evict():
+        for name in names:
+            if name in _ids:
+                del _names[_ids.pop(name)]
+
+    if names:
+        evict()
+        transaction.on_commit(committed)
+
+
+def clear():
+    global _epoch
+    _ids.clear()
+    _names.clear()
+    _epoch = None
+
+
+def lookup(names):
+    # {name: tag id} of the names that are tags, from the in-process map,
+    # then one cache read, then one query
+    global _epoch
+    epoch = cache.get(EPOCH_KEY)
+    if epoch != _epoch:
+        clear()
+        _epoch = epoch
+    ids = {}
+    for name in set(names):
+        if name in _ids:
+            _ids.move_to_end(name)
+            ids[name] = _ids[name]
+    missing = [name for name in set(names) if name not in ids]
+    if not missing:
+        return ids
+    cached = cache.get_many([cache_key(name) for name in missing])
+    found = {name: cached[cache_key(name)] for name in missing
+             if cache_key(name) in cached}
+    stored = [name for name in missing if name not in found]
+    if stored:
+        found.update(models.Tag.objects.filter(
+            name__in=stored).values_list('name', 'id'))
+    store(found)
+    ids.update(found)
+    return ids
+
+
+def resolve(names):
+    # {name: tag id} of every name, creating the missing tags with one bulk
+    # insert
+    ids = lookup(names)
+    new = [name for name in dict.fromkeys(names) if name not in ids]
+    if not new:
+        return ids
+    missing = new
+    while missing:
+        try:
+            with transaction.atomic():
+                models.Tag.objects.bulk_create(models.Tag(name=name)
+                                               for name in missing)
+            break
+        except IntegrityError:
+            # A concurrent request created some of them first, insert the
+            # rest again
+            existing = set(models.Tag.objects.filter(
+                name__in=missing).values_list('name', flat=True))
+            missing = [name for name in missing if name not in existing]
+    created = {}
+    for tag in models.Tag.objects.filter(name__in=new):
+        # bulk_create does not send post_save
+        fuzzy.add_tag(tag)
+        created[tag.name] = tag.id
+    store(created)
+    ids.update(created)
+    return ids
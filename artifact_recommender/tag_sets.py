@@ -0,0 +1,153 @@
+from array import array
+from artifact_recommender import models
+from artifact_recommender import neighbours
+from collections import OrderedDict
+from decision_engine import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import RedisError, WatchError
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Tag ids of each artifact as sorted int arrays, in an in-process LRU map in
+# front of the tagset:<id> cache keys. Every tag change stores a new epoch
+# token, and a process whose map was filled under another epoch drops it,
+# so the maps of other processes never outlive a change.
+EPOCH_KEY = 'tagset:epoch'
+CACHE_ERRORS = (ConnectionInterrupted, RedisError)
+_sets = OrderedDict()
+_epoch = None
+
+
+def cache_key(artifact_id):
+    return 'tagset:{}'.format(artifact_id)
+
+
+def remember(artifact_id, tag_ids):
+    _sets[artifact_id] = tag_ids
+    _sets.move_to_end(artifact_id)
+    while len(_sets) > settings.TAG_SET_CACHE_SIZE:
+        _sets.popitem(last=False)
+
+
+def clear():
+    global _epoch
+    _sets.clear()
+    _epoch = None
+
+
+def store(sets, epoch):
+    # Cache the {artifact id: tag id array} sets read under epoch once
+    # committed, unless the tags changed meanwhile. On Redis the epoch is
+    # watched until the sets are written.
+
+    def committed():
+        values = {cache_key(artifact_id): tag_ids.tobytes()
+                  for artifact_id, tag_ids in sets.items()}
+        connection = neighbours.redis_connection()
+        try:
+            if connection is None:
+                if cache.get(EPOCH_KEY) != epoch:
+                    return
+                cache.set_many(values)
+            else:
+                with connection.pipeline() as pipeline:
+                    pipeline.watch(cache.make_key(EPOCH_KEY))
+                    if cache.get(EPOCH_KEY, client=pipeline) != epoch:
+                        return
+                    pipeline.multi()
+                    for name, value in values.items():
+                        cache.set(name, value, client=pipeline)
+                    pipeline.execute()
+        except WatchError:
+            # The tags changed while storing
+            return
+        except CACHE_ERRORS as e:
+            logger.warning('Can not store tag sets: {}'.format(e))
+            return
+        for artifact_id, tag_ids in sets.items():
+            remember(artifact_id, tag_ids)
+
+    if sets:
+        transaction.on_commit(committed)
+
+
+def invalidate(artifact_ids):
+    # Forget the tag sets of the artifacts now, as the current transaction
+    # reads its own changes, and everywhere once committed
+    artifact_ids = list(artifact_ids)
+
+    def committed():
+        forget()
+        try:
+            cache.delete_many([cache_key(artifact_id)
+                               for artifact_id in artifact_ids])
+            cache.set(EPOCH_KEY, uuid.uuid4().hex, None)
+        except CACHE_ERRORS as e:
+            logger.warning('Can not invalidate tag sets of {}: {}'.format(
+                ', '.join(str(artifact_id) for artifact_id in artifact_ids),
+                e))
+
+    def forget():
+        for artifact_id in artifact_ids:
+            _sets.pop(artifact_id, None)
+
+    if artifact_ids:
+        forget()
+        transaction.on_commit(committed)
+
+
+def load(artifact_ids):
+    # {artifact id: sorted tag id array} read with one query per 500
+    # artifacts
+    artifact_ids = list(artifact_ids)
+    loaded = {artifact_id: [] for artifact_id in artifact_ids}
+    through = models.Artifact.tags.through
+    for start in range(0, len(artifact_ids), 500):
+        for artifact_id, tag_id in through.objects.filter(
+                artifact_id__in=artifact_ids[start:start + 500]).values_list(
+                    'artifact_id', 'tag_id'):
+            loaded[artifact_id].append(tag_id)
+    return {artifact_id: array('i', sorted(tag_ids))
+            for artifact_id, tag_ids in loaded.items()}
+
+
+def lookup(artifact_ids):
+    # {artifact id: sorted tag id array} of every artifact, from the
+    # in-process map, then one cache read, then the database. Without the
+    # cache nothing is remembered.
+    global _epoch
+    artifact_ids = set(artifact_ids)
+    try:
+        epoch = cache.get(EPOCH_KEY)
+        if epoch != _epoch:
+            _sets.clear()
+            _epoch = epoch
+        sets = {}
+        for artifact_id in artifact_ids:
+            if artifact_id in _sets:
+                _sets.move_to_end(artifact_id)
+                sets[artifact_id] = _sets[artifact_id]
+        missing = [artifact_id for artifact_id in artifact_ids
+                   if artifact_id not in sets]
+        if not missing:
+            return sets
+        cached = cache.get_many([cache_key(artifact_id)
+                                 for artifact_id in missing])
+    except CACHE_ERRORS as e:
+        logger.warning('Can not read tag sets: {}'.format(e))
+        return load(artifact_ids)
+    for artifact_id in missing:
+        if cache_key(artifact_id) in cached:
+            tag_ids = array('i')
+            tag_ids.frombytes(cached[cache_key(artifact_id)])
+            remember(artifact_id, tag_ids)
+            sets[artifact_id] = tag_ids
+    loaded = load(artifact_id for artifact_id in missing
+                  if artifact_id not in sets)
+    store(loaded, epoch)
+    sets.update(loaded)
+    return sets
@@ -1,14 +1,35 @@
 from django.test import TestCase, Client, override_settings
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
 from artifact_recommender.models import Dataset, BuildingBlock, Tag
 from artifact_recommender.models import Application, Idea, Similarity
+from artifact_recommender.models import MinHash, LSHBucket
 from artifact_recommender import recommender
 from artifact_recommender import cdv
+from artifact_recommender import fuzzy
+from artifact_recommender import lsh
+from artifact_recommender import neighbours
+from artifact_recommender import pending
+from artifact_recommender import views
+from artifact_recommender import serializers
+from artifact_recommender import tag_ids
+from artifact_recommender import tag_sets
 from decision_engine import settings
 from django.contrib.auth.models import User
 from unittest.mock import patch
+from io import StringIO
+from array import array
 from geopy.exc import GeocoderServiceError
+from redis.exceptions import ConnectionError
+from rest_framework.renderers import JSONRenderer
+import fakeredis
+import Levenshtein
 import base64
 import json
+import math
+import numpy as np
 # Create your tests here.
 
 BASIC_USER = 'test-user'
@@ -24,7 +45,7 @@ class SimilarityTestCase(TestCase):
         self.tag1.save()
         self.tag2 = Tag(name='tag2')
         self.tag2.save()
-        self.tag3 = Tag(name='tag1')
+        self.tag3 = Tag(name='tag3')
         self.tag3.save()
 
     def tearDown(self):
@@ -54,6 +75,172 @@ class TagTestCase(TestCase):
         self.assertEqual(str(tag), 'tag1')
 
 
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class TagIdsTestCase(TestCase):
+    def setUp(self):
+        tag_ids.clear()
+
+    def tearDown(self):
+        tag_ids.clear()
+
+    def test_tag_name_unique(self):
+        Tag.objects.create(name='tag1')
+        with self.assertRaises(IntegrityError):
+            Tag.objects.create(name='tag1')
+
+    def test_lookup(self):
+        tag1 = Tag.objects.create(name='tag1')
+        tag2 = Tag.objects.create(name='tag2')
+
+        # Nothing is remembered before the commit
+        with self.assertNumQueries(1):
+            self.assertDictEqual(tag_ids.lookup(['tag1', 'tag2', 'tag3']),
+                                 {'tag1': tag1.id, 'tag2': tag2.id})
+        with self.assertNumQueries(1):
+            tag_ids.lookup(['tag1'])
+
+        with patch('django.db.transaction.on_commit',
+                   side_effect=lambda committed: committed()):
+            tag_ids.lookup(['tag1', 'tag2'])
+        with self.assertNumQueries(0):
+            self.assertDictEqual(tag_ids.lookup(['tag1', 'tag2']),
+                                 {'tag1': tag1.id, 'tag2': tag2.id})
+
+    @patch('decision_engine.settings.TAG_ID_CACHE_SIZE', 2)
+    def test_remember(self):
+        tag_ids.remember('tag1', 1)
+        tag_ids.remember('tag2', 2)
+        tag_ids.remember('tag1', 1)
+        tag_ids.remember('tag3', 3)
+        self.assertListEqual(list(tag_ids._ids.items()),
+                             [('tag1', 1), ('tag3', 3)])
+
+        # A new tag reusing an id evicts the stale name
+        tag_ids.remember('tag4', 1)
+        self.assertListEqual(list(tag_ids._ids.items()),
+                             [('tag3', 3), ('tag4', 1)])
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    @patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+    def test_deleted_tag(self, mocked_on_commit):
+        cache.clear()
+        Tag.objects.create(name='tag1').delete()
+
+        ids = tag_ids.resolve(['tag1'])
+
+        self.assertDictEqual(ids, {'tag1': Tag.objects.get(name='tag1').id})
+        self.assertEqual(cache.get(tag_ids.cache_key('tag1')), ids['tag1'])
+
+        # Another process deleting a tag drops the whole map
+        cache.set(tag_ids.EPOCH_KEY, 'other')
+        cache.delete(tag_ids.cache_key('tag1'))
+        with self.assertNumQueries(1):
+            tag_ids.lookup(['tag1'])
+
+    def test_resolve_concurrent(self):
+        tag1 = Tag.objects.create(name='tag1')
+
+        with patch('artifact_recommender.tag_ids.lookup', return_value={}):
+            ids = tag_ids.resolve(['tag1', 'tag2', 'tag1'])
+
+        self.assertDictEqual(ids, {'tag1': tag1.id,
+                                   'tag2': Tag.objects.get(name='tag2').id})
+        self.assertEqual(Tag.objects.count(), 2)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+@patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+class TagSetsTestCase(TestCase):
+    def setUp(self):
+        self.rq_patcher = patch('django_rq.enqueue')
+        self.rq_patcher.start()
+        cache.clear()
+        tag_sets.clear()
+        self.tags = [Tag.objects.create(name='tag{}'.format(i))
+                     for i in range(3)]
+        self.dataset = Dataset.objects.create(id=4444, lang='spanish')
+        self.dataset.tags = [self.tags[2], self.tags[0]]
+
+    def tearDown(self):
+        self.rq_patcher.stop()
+        tag_sets.clear()
+
+    def tag_ids(self, tags):
+        return [tag.id for tag in tags]
+
+    def test_lookup(self, mocked_on_commit):
+        with self.assertNumQueries(1):
+            sets = tag_sets.lookup([4444, 4445])
+        self.assertDictEqual(
+            {artifact_id: list(tag_ids) for artifact_id, tag_ids
+             in sets.items()},
+            {4444: self.tag_ids([self.tags[0], self.tags[2]]), 4445: []})
+        with self.assertNumQueries(0):
+            tag_sets.lookup([4444, 4445])
+
+        # Another process changed some tags
+        cache.set(tag_sets.EPOCH_KEY, 'epoch')
+        with self.assertNumQueries(0):
+            tag_sets.lookup([4444])
+        self.assertListEqual(list(tag_sets._sets), [4444])
+
+    def test_invalidate(self, mocked_on_commit):
+        tag_sets.lookup([4444])
+
+        self.dataset.tags.remove(self.tags[0])
+        self.assertListEqual(list(tag_sets.lookup([4444])[4444]),
+                             self.tag_ids([self.tags[2]]))
+        self.tags[1].artifact_set.add(self.dataset)
+        self.assertListEqual(list(tag_sets.lookup([4444])[4444]),
+                             self.tag_ids(self.tags[1:]))
+        self.tags[2].delete()
+        self.assertListEqual(list(tag_sets.lookup([4444])[4444]),
+                             self.tag_ids([self.tags[1]]))
+        self.dataset.tags.clear()
+        self.assertListEqual(list(tag_sets.lookup([4444])[4444]), [])
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django_redis.cache.RedisCache',
+                    'LOCATION': 'redis://localhost:6379/1'}})
+    def test_store_watches_epoch(self, mocked_on_commit):
+        redis = fakeredis.FakeStrictRedis()
+        redis.flushall()
+        get = cache.get
+
+        def retagged(*args, **kwargs):
+            # Another process changes some tags right after the check
+            value = get(*args, **kwargs)
+            tag_sets.invalidate([4445])
+            return value
+
+        def client(write=True, tried=(), show_index=False):
+            return (redis, 0) if show_index else redis
+
+        with patch('django_redis.client.DefaultClient.get_client',
+                   side_effect=client):
+            cache.set(tag_sets.EPOCH_KEY, 'epoch', None)
+            tag_sets.store({4444: array('i', [1, 2])}, 'epoch')
+            self.assertIn(tag_sets.cache_key(4444),
+                          cache.get_many([tag_sets.cache_key(4444)]))
+
+            epoch = cache.get(tag_sets.EPOCH_KEY)
+            with patch('django.core.cache.cache.get', side_effect=retagged):
+                tag_sets.store({4446: array('i', [1])}, epoch)
+            self.assertIsNone(cache.get(tag_sets.cache_key(4446)))
+            self.assertNotIn(4446, tag_sets._sets)
+
+    def test_without_cache(self, mocked_on_commit):
+        with patch('django.core.cache.cache.get',
+                   side_effect=ConnectionError):
+            with self.assertNumQueries(1):
+                tag_sets.lookup([4444])
+            with self.assertNumQueries(1):
+                tag_sets.lookup([4444])
+
+
 class ArtifactTestCase(TestCase):
     def setUp(self):
         self.rq_patcher = patch('django_rq.enqueue')
@@ -63,7 +250,7 @@ class ArtifactTestCase(TestCase):
         self.tag1.save()
         self.tag2 = Tag(name='tag2')
         self.tag2.save()
-        self.tag3 = Tag(name='tag1')
+        self.tag3 = Tag(name='tag3')
         self.tag3.save()
 
     def tearDown(self):
@@ -77,7 +264,7 @@ class ArtifactTestCase(TestCase):
         self.assertEqual(
             str(dataset),
             '4444\nspanish\n<QuerySet [<Tag: tag1>, <Tag: tag2>, '
-            '<Tag: tag1>]>\n')
+            '<Tag: tag3>]>\n')
 
     def test_buldingblock_str(self):
         buildingblock = BuildingBlock(id=4444, lang='spanish')
@@ -87,7 +274,7 @@ class ArtifactTestCase(TestCase):
         self.assertEqual(
             str(buildingblock),
             '4444\nspanish\n<QuerySet [<Tag: tag1>, <Tag: tag2>, '
-            '<Tag: tag1>]>\n')
+            '<Tag: tag3>]>\n')
 
     def test_app_str(self):
         app = Application(id=4444, lang='spanish', scope='Bilbao', min_age=13)
@@ -97,7 +284,7 @@ class ArtifactTestCase(TestCase):
         self.assertEqual(
             str(app),
             '4444\nspanish\n<QuerySet [<Tag: tag1>, <Tag: tag2>, '
-            '<Tag: tag1>]>\n')
+            '<Tag: tag3>]>\n')
 
     def test_idea_str(self):
         idea = Idea(id=4444, lang='spanish')
@@ -107,7 +294,7 @@ class ArtifactTestCase(TestCase):
         self.assertEqual(
             str(idea),
             '4444\nspanish\n<QuerySet [<Tag: tag1>, <Tag: tag2>, '
-            '<Tag: tag1>]>\n')
+            '<Tag: tag3>]>\n')
 
 
 @override_settings(CACHES={
@@ -542,6 +729,93 @@ class DatasetTestCase(TestCase):
         response_json = json.loads(response.content)
         self.assertEqual(len(response_json), 2)
 
+    @patch('decision_engine.settings.STREAM_BATCH_SIZE', 2)
+    def test_get_datasets_paginated(self):
+        tag = Tag.objects.create(name='tag1')
+        for i in range(4444, 4449):
+            Dataset.objects.create(id=i, lang='spanish').tags = [tag]
+
+        response = self.client.get('/dataset/?limit=2')
+        self.assertListEqual([dataset['id'] for dataset in
+                              json.loads(response.content)], [4444, 4445])
+        response = self.client.get('/dataset/?limit=3&cursor={}'.format(
+            response['X-Next-Cursor']))
+        self.assertListEqual([dataset['id'] for dataset in
+                              json.loads(response.content)],
+                             [4446, 4447, 4448])
+        response = self.client.get('/dataset/?limit=3&cursor=4448')
+        self.assertListEqual(json.loads(response.content), [])
+        self.assertNotIn('X-Next-Cursor', response)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/dataset/?stream=ndjson&cursor=4444')
+            lines = b''.join(response.streaming_content).decode().split('\n')
+        # Two batches of two datasets and their tags, then an empty batch
+        self.assertEqual(len([query for query in queries
+                              if 'artifact_recommender' in query['sql'] and
+                              'silk_' not in query['sql']]), 6)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertListEqual([json.loads(line) for line in lines[:-1]], [
+            {'id': i, 'lang': 'spanish', 'tags': ['tag1']}
+            for i in range(4445, 4449)])
+
+        for query in ['limit=0', 'limit=a', 'cursor=a']:
+            response = self.client.get('/dataset/?{}'.format(query))
+            self.assertEqual(response.status_code, 400)
+
+    def create_queries(self, artifact_id, tags):
+        self.mocked_stem_tags.return_value = tags
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                '/dataset/',
+                json.dumps({'id': artifact_id, 'lang': 'spanish',
+                            'tags': tags}),
+                content_type='application/json',
+                **{'HTTP_AUTHORIZATION': 'BASIC {}'.format(
+                    base64.b64encode('{}:{}'.format(
+                         BASIC_USER, BASIC_PASSWORD).encode()).decode())})
+        self.assertEqual(response.status_code, 201)
+        self.assertListEqual(sorted(json.loads(response.content)['tags']),
+                             sorted(tags))
+        return [query for query in queries
+                if 'artifact_recommender' in query['sql'] and
+                'silk_' not in query['sql']]
+
+    def test_create_dataset_bulk_tags(self):
+        Tag.objects.create(name='tag0')
+        few = self.create_queries(4444, ['tag0', 'tag1'])
+        many = self.create_queries(
+            4445, ['tag{}'.format(i) for i in range(40, 0, -1)])
+
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(Tag.objects.count(), 41)
+
+    def list_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query for query in queries
+                if 'artifact_recommender' in query['sql'] and
+                'silk_' not in query['sql']]
+
+    def test_get_datasets_constant_queries(self):
+        tag1 = Tag.objects.create(name='tag1')
+        tag2 = Tag.objects.create(name='tag2')
+        Dataset.objects.create(id=1, lang='spanish').tags = [tag1, tag2]
+        one = self.list_queries('/dataset/')
+        detail = self.list_queries('/dataset/1/')
+
+        for i in range(2, 1001):
+            Dataset.objects.create(id=i, lang='spanish')
+        Dataset.tags.through.objects.bulk_create(
+            Dataset.tags.through(artifact_id=i, tag_id=tag.id)
+            for i in range(2, 1001) for tag in [tag1, tag2])
+
+        self.assertEqual(len(self.list_queries('/dataset/')), len(one))
+        self.assertEqual(len(self.list_queries('/dataset/1000/')),
+                         len(detail))
+        self.assertEqual(len(one), 2)
+
     def test_get_dataset(self):
         response = self.client.post(
             '/dataset/',
@@ -1053,6 +1327,164 @@ class IdeaTestCase(TestCase):
         self.assertListEqual(response_json['tags'], ['tag1', 'tag2'])
 
 
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class ArtifactRowsTestCase(TestCase):
+    def setUp(self):
+        self.rq_patcher = patch('django_rq.enqueue')
+        self.rq_patcher.start()
+
+    def tearDown(self):
+        self.rq_patcher.stop()
+
+    def test_artifact_rows(self):
+        tags = [Tag.objects.create(name=name)
+                for name in ['tag1', 'etiquetañ', 'tag ']]
+        Dataset.objects.create(id=1, lang='spanish').tags = tags
+        Dataset.objects.create(id=2, lang='english')
+        BuildingBlock.objects.create(id=3, lang='spanish').tags = tags[:1]
+        Application.objects.create(id=4, lang='spanish', scope='Bilbao',
+                                   min_age=13).tags = tags[1:]
+        Idea.objects.create(id=5, lang='basque').tags = tags[2:]
+        renderer = JSONRenderer()
+
+        for model, serializer_class in [
+                (Dataset, serializers.DatasetSerializer),
+                (BuildingBlock, serializers.BuildingBlockSerializer),
+                (Application, serializers.ApplicationSerializer),
+                (Idea, serializers.IdeaSerializer)]:
+            queryset = model.objects.order_by('pk')
+            with self.assertNumQueries(2):
+                rows = serializers.artifact_rows(queryset, serializer_class)
+            self.assertEqual(
+                renderer.render(rows),
+                renderer.render(serializer_class(queryset, many=True).data))
+
+    def test_resolved_tag_ids(self):
+        tag = Tag.objects.create(name='tag1')
+        data = {'id': 1, 'lang': 'spanish', 'tags': ['tag1']}
+
+        serializer = serializers.DatasetSerializer(
+            data=data, context={'tag_ids': {'tag1': tag.id}})
+        # Only the id uniqueness check, no tag query
+        with self.assertNumQueries(1):
+            self.assertTrue(serializer.is_valid())
+        self.assertListEqual(serializer.validated_data['tags'], [tag.id])
+        serializer.save()
+        self.assertListEqual(serializer.data['tags'], ['tag1'])
+
+        serializer = serializers.DatasetSerializer(
+            data=dict(data, tags=['tag2']), context={'tag_ids': {}})
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('tags', serializer.errors)
+
+    def test_benchmark_serialization(self):
+        out = StringIO()
+
+        call_command('benchmark_serialization', sizes=[20], tags=3,
+                     stdout=out)
+
+        self.assertIn('20 datasets', out.getvalue())
+        self.assertIn('identical output', out.getvalue())
+        self.assertEqual(Dataset.objects.count(), 0)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class ArtifactImportTestCase(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(BASIC_USER, password=BASIC_PASSWORD)
+        user.save()
+
+        self.rq_patcher = patch('django_rq.enqueue')
+        self.mocked_enqueue = self.rq_patcher.start()
+
+    def tearDown(self):
+        self.rq_patcher.stop()
+        tag_ids.clear()
+        tag_sets.clear()
+
+    def post(self, url, body, content_type='application/json'):
+        return self.client.post(
+            url, body, content_type=content_type,
+            **{'HTTP_AUTHORIZATION': 'BASIC {}'.format(
+                base64.b64encode('{}:{}'.format(
+                     BASIC_USER, BASIC_PASSWORD).encode()).decode())})
+
+    @patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+    def test_import_datasets(self, mocked_on_commit):
+        Idea.objects.create(id=4444, lang='english')
+        Tag.objects.create(name='tag1')
+
+        response = self.post('/dataset/import/', json.dumps(
+            [{'id': 4444, 'lang': 'english', 'tags': ['tag1']},
+             {'id': 4445, 'lang': 'english',
+              'tags': ['tag1', 'running', 'runs']},
+             {'id': 4446, 'lang': 'basque', 'tags': ['running']},
+             {'id': 4445, 'lang': 'english', 'tags': []}]))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertDictEqual(json.loads(response.content),
+                             {'created': 2, 'skipped': [4444, 4445]})
+        self.assertListEqual(
+            [(dataset.id, dataset.lang, sorted(dataset.tags.values_list(
+                'name', flat=True)))
+             for dataset in Dataset.objects.order_by('id')],
+            [(4445, 'english', ['run', 'tag1']),
+             (4446, 'basque', ['running'])])
+        self.assertListEqual(
+            list(Tag.objects.order_by('name').values_list(
+                'name', 'artifact_count')),
+            [('run', 1), ('running', 1), ('tag1', 1)])
+        self.mocked_enqueue.assert_called_once_with(
+            recommender.tag_similarity_batch, [4445, 4446])
+
+    def test_import_apps_ndjson(self):
+        response = self.post(
+            '/app/import/',
+            '{"id": 4444, "lang": "english", "tags": ["tag1"], '
+            '"scope": "Bilbao", "min_age": 13}\n\n'
+            '{"id": 4445, "lang": "english", "tags": [], "scope": "Bilbao"}',
+            content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertListEqual(
+            list(Application.objects.order_by('id').values_list(
+                'id', 'scope', 'min_age')),
+            [(4444, 'Bilbao', 13), (4445, 'Bilbao', 0)])
+
+    def test_import_constant_queries(self):
+        def import_queries(ids):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post('/idea/import/', json.dumps(
+                    [{'id': i, 'lang': 'english',
+                      'tags': ['tag{}'.format(i), 'tag']} for i in ids]))
+            self.assertEqual(response.status_code, 201)
+            return [query for query in queries
+                    if 'artifact_recommender' in query['sql'] and
+                    'silk_' not in query['sql']]
+
+        self.assertEqual(len(import_queries(range(1, 3))),
+                         len(import_queries(range(3, 33))))
+        self.assertEqual(Idea.objects.count(), 32)
+
+    def test_import_bad_request(self):
+        for body in ['{"id": 4444', '{"id": 4444}',
+                     json.dumps([{'id': 'a', 'lang': 'english',
+                                  'tags': []}]),
+                     json.dumps([{'id': 4444, 'lang': 'english'}])]:
+            response = self.post('/dataset/import/', body)
+            self.assertEqual(response.status_code, 400)
+        response = self.post('/dataset/import/', '{"id": 4444',
+                             content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Dataset.objects.count(), 0)
+
+        response = self.client.post('/dataset/import/', json.dumps([]),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+
 class MockedStemmer():
 
     def __init__(self, lang='spanish'):
@@ -1068,6 +1500,8 @@ class TestRecommender(TestCase):
     def setUp(self):
         self.rq_patcher = patch('django_rq.enqueue')
         self.rq_patcher.start()
+        # Tag ids of rolled back tests are reused
+        fuzzy._tree = None
 
     def tearDown(self):
         self.rq_patcher.stop()
@@ -1269,6 +1703,813 @@ class TestRecommender(TestCase):
              '4444 - 4447: 0.5',
              '4444 - 4448: 0.5'])
 
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_tag_similarity_neighbourhood(self):
+        tag1 = Tag.objects.create(name='tag1')
+        tag2 = Tag.objects.create(name='tag2')
+        other = Tag.objects.create(name='other')
+        source = Dataset.objects.create(id=4444, lang='spanish')
+        source.tags = [tag1, tag2]
+        related = Dataset.objects.create(id=4445, lang='spanish')
+        related.tags = [tag1]
+        for i in range(4446, 4466):
+            unrelated = Dataset.objects.create(id=i, lang='spanish')
+            unrelated.tags = [other]
+
+        # source language, source tags, postings, neighbourhood tags, target
+        # types and a savepoint wrapping one delete and one bulk insert
+        with self.assertNumQueries(9):
+            recommender.tag_similarity(source.id)
+
+        self.assertListEqual(
+            [str(similarity) for similarity in Similarity.objects.all()],
+            ['4444 - 4445: 0.5'])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_tag_similarity_retag(self):
+        tag1 = Tag.objects.create(name='tag1')
+        tag2 = Tag.objects.create(name='tag2')
+        source = Dataset.objects.create(id=4444, lang='spanish')
+        source.tags = [tag1, tag2]
+        target1 = Dataset.objects.create(id=4445, lang='spanish')
+        target1.tags = [tag1]
+        target2 = Dataset.objects.create(id=4446, lang='spanish')
+        target2.tags = [tag2]
+        recommender.tag_similarity(source.id)
+
+        source.tags = [tag1]
+        recommender.tag_similarity(source.id)
+
+        self.assertListEqual(
+            [str(similarity) for similarity in Similarity.objects.all()],
+            ['4444 - 4445: 1.0'])
+
+    def test_save_similarities(self):
+        for i in range(4444, 4448):
+            Dataset.objects.create(id=i, lang='spanish')
+        recommender.save_similarities(4444, {4445: 0.5, 4446: 1.0})
+        recommender.save_similarities(4447, {4445: 0.2})
+
+        recommender.save_similarities(4444, {4446: 0.25, 4447: 0.75})
+
+        self.assertListEqual(
+            [str(similarity) for similarity in Similarity.objects.all()],
+            ['4445 - 4447: 0.2', '4444 - 4446: 0.25', '4444 - 4447: 0.75'])
+
+    @patch('decision_engine.settings.SIMILARITY_TOP_K', 2)
+    @patch('decision_engine.settings.SIMILARITY_MIN_VALUE', 0.3)
+    def test_save_similarities_pruned(self):
+        Dataset.objects.create(id=4444, lang='spanish')
+        for i in range(4445, 4449):
+            Dataset.objects.create(id=i, lang='spanish')
+        for i in range(4449, 4452):
+            Application.objects.create(id=i, lang='spanish')
+
+        # 4445 has two better datasets, 4447 none
+        for target_id, value in [(4446, 0.9), (4448, 0.8)]:
+            Similarity.objects.create(
+                source_artifact_id=4445, target_artifact_id=target_id,
+                source_type='dataset', target_type='dataset', value=value)
+
+        recommender.save_similarities(4444, {4445: 0.5, 4446: 1.0,
+                                             4447: 0.5, 4448: 0.75,
+                                             4449: 0.25, 4450: 0.3,
+                                             4451: 0.4})
+
+        similarities = Similarity.objects.filter(
+            source_artifact_id=4444).order_by('target_artifact_id')
+        self.assertListEqual(
+            [str(similarity) for similarity in similarities],
+            ['4444 - 4446: 1.0', '4444 - 4447: 0.5', '4444 - 4448: 0.75',
+             '4444 - 4451: 0.4'])
+        self.assertListEqual(
+            list(similarities.values_list('source_type', 'target_type')),
+            [('dataset', 'dataset'), ('dataset', 'dataset'),
+             ('dataset', 'dataset'), ('dataset', 'app')])
+
+    @patch('decision_engine.settings.SIMILARITY_TOP_K', 1)
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_similarities_kept_for_either_artifact(self):
+        tags = [Tag.objects.create(name='tag{}'.format(i)) for i in range(7)]
+        for artifact_id, artifact_tags in [(4444, [0, 1]),
+                                           (4445, [0, 2, 3, 4, 5]),
+                                           (4446, [0, 1, 6])]:
+            Dataset.objects.create(id=artifact_id, lang='spanish').tags = [
+                tags[i] for i in artifact_tags]
+
+        def similarities():
+            return [str(similarity) for similarity in
+                    Similarity.objects.order_by('source_artifact_id',
+                                                'target_artifact_id')]
+
+        expected = ['4444 - 4445: 0.16666666666666666',
+                    '4444 - 4446: 0.6666666666666666']
+        with transaction.atomic():
+            # 4444 is the best dataset of 4445, but 4445 not that of 4444
+            for artifact_id in [4445, 4444, 4446]:
+                recommender.tag_similarity(artifact_id)
+            self.assertListEqual(similarities(), expected)
+            transaction.set_rollback(True)
+
+        recommender.tag_similarity_batch([4445, 4444, 4446])
+        self.assertListEqual(similarities(), expected)
+
+    def test_artifact_types(self):
+        Dataset.objects.create(id=4444, lang='spanish')
+        BuildingBlock.objects.create(id=4445, lang='spanish')
+        Application.objects.create(id=4446, lang='spanish')
+        Idea.objects.create(id=4447, lang='spanish')
+
+        self.assertDictEqual(
+            recommender.artifact_types([4444, 4445, 4446, 4447, 4448]),
+            {4444: 'dataset', 4445: 'buildingblock', 4446: 'app',
+             4447: 'idea'})
+
+    def test_jaccard_block(self):
+        random = np.random.RandomState(0)
+        targets = [array('i', sorted(random.choice(
+            20, random.randint(0, 6), replace=False).tolist()))
+            for _ in range(50)]
+        for source in [array('i', [1, 4, 7, 9]), array('i')]:
+            self.assertListEqual(
+                recommender.jaccard_block(source, targets).tolist(),
+                [recommender.tags_similarity(set(source), set(target))
+                 for target in targets])
+        self.assertListEqual(recommender.jaccard_block(
+            array('i', [1]), []).tolist(), [])
+
+        weights = {tag: random.rand() for tag in range(20)}
+        weights[4] = 0
+        source = array('i', [1, 4, 7, 9])
+        self.assertTrue(np.allclose(
+            recommender.jaccard_block(source, targets, weights),
+            [recommender.tags_similarity(set(source), set(target), weights)
+             for target in targets]))
+        self.assertEqual(recommender.tags_similarity({4}, {4}, weights), 0)
+
+    def test_benchmark_jaccard(self):
+        out = StringIO()
+
+        call_command('benchmark_jaccard', sizes=[10, 100], tags=3,
+                     stdout=out)
+
+        self.assertIn('100 candidates', out.getvalue())
+        self.assertEqual(out.getvalue().count('identical scores'), 2)
+
+
+class LSHTestCase(TestCase):
+    def setUp(self):
+        self.rq_patcher = patch('django_rq.enqueue')
+        self.rq_patcher.start()
+
+    def tearDown(self):
+        self.rq_patcher.stop()
+
+    def test_minhash_signature(self):
+        signature = lsh.minhash_signature(['tag1', 'tag2'])
+
+        self.assertEqual(len(signature), settings.MINHASH_PERMUTATIONS)
+        self.assertListEqual(signature, lsh.minhash_signature(['tag2',
+                                                               'tag1']))
+        self.assertListEqual(lsh.minhash_signature([]), [])
+
+    def test_estimated_similarity(self):
+        signature = lsh.minhash_signature(['tag1', 'tag2', 'tag3'])
+
+        self.assertEqual(lsh.estimated_similarity(signature, signature), 1.0)
+        self.assertEqual(lsh.estimated_similarity(
+            signature, lsh.minhash_signature(['tag4', 'tag5'])), 0)
+        self.assertEqual(lsh.estimated_similarity([], []), 0)
+
+    def test_lsh_buckets(self):
+        signature = lsh.minhash_signature(['tag1', 'tag2'])
+        buckets = lsh.lsh_buckets(signature)
+
+        self.assertEqual(len(buckets), settings.LSH_BANDS)
+        self.assertListEqual([band for band, bucket in buckets],
+                             list(range(settings.LSH_BANDS)))
+        self.assertListEqual(lsh.lsh_buckets([]), [])
+
+    @patch('decision_engine.settings.SIMILARITY_LSH', True)
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_rebuild_signatures(self):
+        tags = [Tag.objects.create(name='tag{}'.format(i)) for i in range(5)]
+        for artifact_id in [4444, 4445]:
+            Dataset.objects.create(id=artifact_id, lang='spanish').tags = tags
+        Dataset.objects.create(id=4446, lang='spanish')
+        out = StringIO()
+
+        call_command('rebuild_similarity', stdout=out)
+
+        self.assertIn('Stored 3 signatures', out.getvalue())
+        self.assertEqual(LSHBucket.objects.count(), 2 * settings.LSH_BANDS)
+        self.assertEqual(MinHash.objects.get(artifact_id=4444).signature,
+                         ','.join(map(str, lsh.minhash_signature(
+                             [tag.name for tag in tags]))))
+        self.assertSetEqual(lsh.candidates(4444, set(
+            tag.name for tag in tags)), {4445})
+
+    @patch('decision_engine.settings.SIMILARITY_LSH', True)
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_tag_similarity_lsh(self):
+        tags = [Tag.objects.create(name='tag{}'.format(i))
+                for i in range(10)]
+        similar = Dataset.objects.create(id=4444, lang='spanish')
+        similar.tags = tags[:5]
+        dissimilar = Dataset.objects.create(id=4445, lang='spanish')
+        dissimilar.tags = [tags[0]] + tags[5:]
+        source = Dataset.objects.create(id=4446, lang='spanish')
+        source.tags = tags[:5]
+        recommender.tag_similarity(similar.id)
+        recommender.tag_similarity(dissimilar.id)
+        Similarity.objects.all().delete()
+
+        recommender.tag_similarity(source.id)
+
+        self.assertListEqual(
+            [str(similarity) for similarity in Similarity.objects.all()],
+            ['4444 - 4446: 1.0'])
+        self.assertEqual(MinHash.objects.count(), 3)
+        self.assertEqual(LSHBucket.objects.filter(artifact=source).count(),
+                         settings.LSH_BANDS)
+
+        Similarity.objects.all().delete()
+        with patch('artifact_recommender.tag_sets.lookup',
+                   wraps=tag_sets.lookup) as lookup:
+            recommender.tag_similarity_batch([source.id])
+        self.assertListEqual(
+            [str(similarity) for similarity in Similarity.objects.all()],
+            ['4444 - 4446: 1.0'])
+        # Artifacts sharing a tag but not an LSH bucket are not scored
+        self.assertNotIn(dissimilar.id, set().union(*(
+            set(args[0]) for args, _ in lookup.call_args_list)))
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class FuzzyTestCase(TestCase):
+    NAMES = ['tag1', 'tag2', 'tags', 'stag', 'transport', 'transports',
+             'data', 'date', 'datum', 'mobility']
+
+    def setUp(self):
+        fuzzy._tree = None
+
+    def test_bktree_search(self):
+        tree = fuzzy.BKTree(self.NAMES)
+
+        for name in self.NAMES + ['tag', 'dat', 'foo']:
+            for max_distance in range(3):
+                self.assertSetEqual(
+                    tree.search(name, max_distance),
+                    set(other for other in self.NAMES
+                        if Levenshtein.distance(name, other) <=
+                        max_distance))
+
+    def test_bktree_empty(self):
+        self.assertSetEqual(fuzzy.BKTree().search('tag1', 1), set())
+
+    def test_near_tags(self):
+        for name in self.NAMES:
+            Tag.objects.create(name=name)
+
+        self.assertSetEqual(fuzzy.near_tags(['tag1', 'data'], 1),
+                            {'tag1', 'tag2', 'tags', 'data', 'date'})
+
+        Tag.objects.create(name='tag3')
+
+        self.assertSetEqual(fuzzy.near_tags(['tag1'], 1),
+                            {'tag1', 'tag2', 'tag3', 'tags'})
+
+    def test_tag_tree_catch_up(self):
+        Tag.objects.create(name='tag1')
+        tree = fuzzy.tag_tree()
+        # Tags created by other processes never reach the local signal
+        tag = Tag(name='tag2')
+        with patch('artifact_recommender.fuzzy.add_tag'):
+            tag.save()
+
+        self.assertSetEqual(tree.search('tag1', 1), {'tag1'})
+        self.assertSetEqual(fuzzy.tag_tree().search('tag1', 1),
+                            {'tag1', 'tag2'})
+
+    def test_tag_tree_late_commit(self):
+        Tag.objects.create(id=1, name='data')
+        Tag.objects.create(id=3, name='mobility')
+        self.assertSetEqual(fuzzy.near_tags(['date'], 1), {'data'})
+
+        # Another process commits a lower id after the tree read the higher
+        Tag.objects.create(id=2, name='date')
+
+        self.assertSetEqual(fuzzy.near_tags(['date'], 1), {'data', 'date'})
+        self.assertSetEqual(fuzzy.tag_tree().missing_ids, set())
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class RebuildSimilarityTestCase(TestCase):
+    def setUp(self):
+        self.rq_patcher = patch('django_rq.enqueue')
+        self.rq_patcher.start()
+
+        tags = [Tag.objects.create(name='tag{}'.format(i)) for i in range(4)]
+        for i, artifact_tags in enumerate([[0, 1], [0, 1], [0], [2, 3],
+                                           [1, 2, 3], []]):
+            dataset = Dataset.objects.create(id=4444 + i, lang='spanish')
+            dataset.tags = [tags[j] for j in artifact_tags]
+
+    def tearDown(self):
+        self.rq_patcher.stop()
+
+    def similarities(self):
+        return sorted((similarity.source_artifact_id,
+                       similarity.target_artifact_id,
+                       round(similarity.value, 4))
+                      for similarity in Similarity.objects.all())
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_rebuild_similarity(self):
+        Similarity.objects.create(source_artifact_id=4444,
+                                  target_artifact_id=4449, value=1.0)
+
+        Similarity.objects.create(source_artifact_id=4448,
+                                  target_artifact_id=4444, value=1.0)
+        out = StringIO()
+
+        call_command('rebuild_similarity', chunk_size=2, stdout=out)
+
+        self.assertListEqual(self.similarities(), [
+            (4444, 4445, 1.0), (4444, 4446, 0.5), (4444, 4448, 0.25),
+            (4445, 4446, 0.5), (4445, 4448, 0.25), (4447, 4448, 0.6667)])
+        self.assertEqual(Similarity.objects.exclude(
+            source_type='dataset', target_type='dataset').count(), 0)
+        self.assertIn('Shard 0-2: 5 similarities', out.getvalue())
+        self.assertIn('Shard 2-4: 1 similarities', out.getvalue())
+        self.assertIn('Shard 4-6: 0 similarities', out.getvalue())
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_rebuild_similarity_matches_tag_similarity(self):
+        for i in range(4444, 4450):
+            recommender.tag_similarity(i)
+        expected = set((min(source, target), max(source, target), value)
+                       for source, target, value in self.similarities())
+
+        call_command('rebuild_similarity', stdout=StringIO())
+
+        self.assertSetEqual(set(self.similarities()), expected)
+
+    @patch('decision_engine.settings.SIMILARITY_TOP_K', 1)
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_tag_similarity_batch(self):
+        idea = Idea.objects.create(id=4450, lang='basque')
+        idea.tags = Tag.objects.filter(name__in=['tag0', 'tag2'])
+        call_command('rebuild_similarity', stdout=StringIO())
+        order = [4446, 4444, 4450, 4449, 4445]
+        with transaction.atomic():
+            for i in order:
+                recommender.tag_similarity(i)
+            expected = self.similarities()
+            transaction.set_rollback(True)
+
+        with self.assertNumQueries(12):
+            recommender.tag_similarity_batch(order + [4444, 9999])
+
+        self.assertListEqual(self.similarities(), expected)
+
+    @patch('decision_engine.settings.SIMILARITY_TOP_K', 1)
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_rebuild_similarity_top_k_per_type(self):
+        idea = Idea.objects.create(id=4450, lang='spanish')
+        idea.tags = Tag.objects.filter(name='tag3')
+
+        call_command('rebuild_similarity', stdout=StringIO())
+
+        # 4450 is the only idea similar to 4448, whose best artifact is 4447
+        self.assertListEqual(self.similarities(), [
+            (4444, 4445, 1.0), (4444, 4446, 0.5), (4445, 4446, 0.5),
+            (4447, 4448, 0.6667), (4447, 4450, 0.5), (4448, 4450, 0.3333)])
+
+    @patch('decision_engine.settings.SIMILARITY_WEIGHTING', 'idf')
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_idf_weighting(self):
+        with transaction.atomic():
+            for i in range(4444, 4450):
+                recommender.tag_similarity(i)
+            expected = self.similarities()
+            transaction.set_rollback(True)
+        common, rare = math.log(7 / 4), math.log(7 / 3)
+        self.assertIn((4447, 4448, round(2 * rare / (common + 2 * rare), 4)),
+                      expected)
+
+        with transaction.atomic():
+            recommender.tag_similarity_batch(range(4444, 4450))
+            self.assertListEqual(self.similarities(), expected)
+            transaction.set_rollback(True)
+
+        call_command('rebuild_similarity', stdout=StringIO())
+        self.assertListEqual(self.similarities(), expected)
+
+        # tag0 and tag1 weigh nothing
+        with patch('decision_engine.settings.SIMILARITY_MIN_IDF', 0.7):
+            call_command('rebuild_similarity', stdout=StringIO())
+            self.assertListEqual(self.similarities(), [(4447, 4448, 1.0)])
+
+            Similarity.objects.all().delete()
+            recommender.tag_similarity(4444)
+            self.assertListEqual(self.similarities(), [])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_rebuild_similarity_threshold_top_k(self):
+        call_command('rebuild_similarity', threshold=0.3, stdout=StringIO())
+
+        self.assertListEqual(self.similarities(), [
+            (4444, 4445, 1.0), (4444, 4446, 0.5), (4445, 4446, 0.5),
+            (4447, 4448, 0.6667)])
+
+        call_command('rebuild_similarity', top_k=1, stdout=StringIO())
+
+        self.assertListEqual(self.similarities(), [
+            (4444, 4445, 1.0), (4444, 4446, 0.5), (4445, 4446, 0.5),
+            (4447, 4448, 0.6667)])
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+@patch('django.db.transaction.on_commit', side_effect=lambda f: f())
+class PendingTestCase(TestCase):
+    def setUp(self):
+        self.rq_patcher = patch('django_rq.enqueue')
+        self.mocked_enqueue = self.rq_patcher.start()
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.redis_patcher = patch(
+            'artifact_recommender.neighbours.redis_connection',
+            return_value=self.redis)
+        self.mocked_connection = self.redis_patcher.start()
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        self.rq_patcher.stop()
+        # Tags remembered by the committed callbacks are rolled back
+        tag_ids.clear()
+        tag_sets.clear()
+
+    @patch('artifact_recommender.recommender.tag_similarity_batch')
+    def test_coalesce(self, mocked_batch, mocked_on_commit):
+        pending.schedule([4444])
+        pending.schedule([4444, 4445])
+        pending.schedule([4446])
+        self.mocked_enqueue.assert_called_once_with(pending.drain)
+        self.assertEqual(self.redis.scard(pending.PENDING_KEY), 3)
+
+        with patch('decision_engine.settings.SIMILARITY_DRAIN_SIZE', 2):
+            pending.drain()
+        self.assertEqual(mocked_batch.call_count, 2)
+        self.assertListEqual(
+            sorted(id for call in mocked_batch.call_args_list
+                   for id in call[0][0]), [4444, 4445, 4446])
+        self.assertEqual(self.redis.scard(pending.PENDING_KEY), 0)
+
+        # A new drain job is enqueued once the previous one started
+        pending.schedule([4444])
+        self.assertEqual(self.mocked_enqueue.call_count, 2)
+
+    def test_failed_drain(self, mocked_on_commit):
+        pending.schedule([4444, 4445, 4446])
+
+        with patch('artifact_recommender.recommender.tag_similarity_batch',
+                   side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                pending.drain()
+
+        self.assertSetEqual(self.redis.smembers(pending.PENDING_KEY),
+                            {b'4444', b'4445', b'4446'})
+
+    def test_without_redis(self, mocked_on_commit):
+        self.mocked_connection.return_value = None
+        pending.schedule([4444])
+        self.mocked_enqueue.assert_called_once_with(
+            recommender.tag_similarity_batch, [4444])
+
+        self.mocked_connection.return_value = self.redis
+        self.mocked_enqueue.reset_mock()
+        with patch.object(self.redis, 'pipeline',
+                          side_effect=ConnectionError):
+            pending.schedule([4445])
+        self.mocked_enqueue.assert_called_once_with(
+            recommender.tag_similarity_batch, [4445])
+
+    def test_signal(self, mocked_on_commit):
+        dataset = Dataset.objects.create(id=4444, lang='english')
+        dataset.tags = [Tag.objects.create(name='tag1')]
+        self.mocked_enqueue.assert_called_once_with(pending.drain)
+        self.assertSetEqual(self.redis.smembers(pending.PENDING_KEY),
+                            {b'4444'})
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+class SimilaritySignalsTestCase(TestCase):
+    def setUp(self):
+        self.schedule_patcher = patch('artifact_recommender.pending.schedule')
+        self.mocked_schedule = self.schedule_patcher.start()
+
+        self.tags = [Tag.objects.create(name='tag{}'.format(i))
+                     for i in range(4)]
+        self.dataset = Dataset.objects.create(id=4444, lang='spanish')
+        self.idea = Idea.objects.create(id=4445, lang='spanish')
+
+    def tearDown(self):
+        self.schedule_patcher.stop()
+
+    def test_forward(self):
+        self.dataset.tags.add(self.tags[0], self.tags[1])
+        self.mocked_schedule.assert_called_once_with([4444])
+
+        # Nothing changes
+        self.mocked_schedule.reset_mock()
+        self.dataset.tags.add(self.tags[0])
+        self.dataset.tags = [self.tags[0], self.tags[1]]
+        self.mocked_schedule.assert_not_called()
+
+        self.dataset.tags.remove(self.tags[1])
+        self.mocked_schedule.assert_called_once_with([4444])
+
+        self.mocked_schedule.reset_mock()
+        self.dataset.tags.clear()
+        self.dataset.tags.clear()
+        self.mocked_schedule.assert_called_once_with([4444])
+
+    def test_reverse(self):
+        self.tags[0].artifact_set.add(self.idea, self.dataset)
+        self.mocked_schedule.assert_called_once_with([4444, 4445])
+
+        self.mocked_schedule.reset_mock()
+        self.tags[0].artifact_set.remove(self.idea)
+        self.mocked_schedule.assert_called_once_with([4445])
+
+        self.mocked_schedule.reset_mock()
+        self.tags[1].artifact_set.add(self.idea)
+        self.tags[1].artifact_set.clear()
+        self.mocked_schedule.assert_called_with([4445])
+
+        self.mocked_schedule.reset_mock()
+        self.tags[0].delete()
+        self.mocked_schedule.assert_called_once_with([4444])
+
+    def test_artifact_count(self):
+        def counts():
+            return [tag.artifact_count for tag in
+                    Tag.objects.filter(name__startswith='tag').order_by('id')]
+
+        self.dataset.tags.add(*self.tags[:3])
+        self.dataset.tags.remove(self.tags[2], self.tags[3])
+        self.idea.tags = self.tags[:2]
+        self.assertListEqual(counts(), [2, 2, 0, 0])
+
+        self.tags[3].artifact_set.add(self.idea, self.dataset)
+        self.tags[0].artifact_set.remove(self.idea)
+        self.tags[1].artifact_set.clear()
+        self.assertListEqual(counts(), [1, 0, 0, 2])
+
+        self.dataset.tags.clear()
+        self.idea.delete()
+        self.assertListEqual(counts(), [0, 0, 0, 0])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_retag_writes_affected_pairs(self):
+        self.dataset.tags = self.tags[:2]
+        self.idea.tags = [self.tags[0], self.tags[3]]
+        Dataset.objects.create(id=4446, lang='spanish').tags = [self.tags[1]]
+        Dataset.objects.create(id=4447, lang='spanish').tags = [self.tags[2]]
+        recommender.tag_similarity(4444)
+        kept = Similarity.objects.get(target_artifact_id=4445)
+
+        self.dataset.tags = [self.tags[0], self.tags[2]]
+        recommender.tag_similarity(4444)
+
+        self.assertListEqual(
+            [str(similarity) for similarity in
+             Similarity.objects.order_by('target_artifact_id')],
+            ['4444 - 4445: 0.3333333333333333', '4444 - 4447: 0.5'])
+        self.assertEqual(Similarity.objects.get(target_artifact_id=4445).pk,
+                         kept.pk)
+
+
+class NeighboursTestCase(TestCase):
+    def setUp(self):
+        self.rq_patcher = patch('django_rq.enqueue')
+        self.rq_patcher.start()
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+        self.redis_patcher = patch(
+            'artifact_recommender.neighbours.redis_connection',
+            return_value=self.redis)
+        self.redis_patcher.start()
+
+        self.tag1 = Tag.objects.create(name='tag1')
+        self.tag2 = Tag.objects.create(name='tag2')
+        dataset = Dataset.objects.create(id=4444, lang='spanish')
+        dataset.tags = [self.tag1, self.tag2]
+        dataset = Dataset.objects.create(id=4445, lang='spanish')
+        dataset.tags = [self.tag1]
+        idea = Idea.objects.create(id=4446, lang='spanish')
+        idea.tags = [self.tag1, self.tag2]
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        self.rq_patcher.stop()
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_materialise(self):
+        recommender.tag_similarity(4444)
+
+        self.assertListEqual(neighbours.cached(4444, 'artifact'),
+                             [(4446, 1.0), (4445, 0.5)])
+        self.assertListEqual(neighbours.cached(4444, 'dataset'),
+                             [(4445, 0.5)])
+        self.assertListEqual(neighbours.cached(4444, 'idea'),
+                             [(4446, 1.0)])
+        self.assertIsNone(neighbours.cached(4444, 'app'))
+        self.assertIsNone(neighbours.cached(4445, 'artifact'))
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_materialise_batch(self):
+        self.client.get('/idea/4446/recommend/artifact/')
+
+        recommender.tag_similarity_batch([4444, 4445])
+
+        self.assertListEqual(neighbours.cached(4444, 'artifact'),
+                             [(4446, 1.0), (4445, 0.5)])
+        self.assertListEqual(neighbours.cached(4445, 'dataset'),
+                             [(4444, 0.5)])
+        self.assertIsNone(neighbours.cached(4446, 'artifact'))
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_similarity_query(self):
+        recommender.tag_similarity(4444)
+
+        with self.assertNumQueries(1):
+            self.assertListEqual(
+                list(neighbours.similarity_query(4444, 'artifact')),
+                [(4446, 1.0, 'idea'), (4445, 0.5, 'dataset')])
+        with self.assertNumQueries(1):
+            self.assertListEqual(
+                list(neighbours.similarity_query(4445, 'dataset')),
+                [(4444, 0.5, 'dataset')])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_recommend_cached(self):
+        recommender.tag_similarity(4444)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/dataset/4444/recommend/artifact/')
+        self.assertListEqual(json.loads(response.content), [4446, 4445])
+        self.assertFalse([query for query in queries if
+                          'artifact_recommender_similarity' in query['sql']])
+
+        response = self.client.get('/dataset/4445/recommend/artifact/')
+        self.assertListEqual(json.loads(response.content), [4444])
+        self.assertListEqual(neighbours.cached(4445, 'artifact'),
+                             [(4444, 0.5)])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_recommend_paginated_miss_stores_list(self):
+        recommender.tag_similarity(4444)
+        neighbours.invalidate_many([4444])
+
+        response = self.client.get(
+            '/dataset/4444/recommend/artifact/?limit=1&offset=1')
+
+        self.assertListEqual(json.loads(response.content), [4445])
+        self.assertListEqual(neighbours.cached(4444, 'artifact'),
+                             [(4446, 1.0), (4445, 0.5)])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_store_after_invalidation(self):
+        recommender.tag_similarity(4444)
+        self.assertGreater(self.redis.ttl('recommend:4444:artifact'), 0)
+
+        # A list loaded before the change is not stored after it
+        read = neighbours.versions([4445])
+        recommender.tag_similarity(4445)
+        neighbours.store_many({(4445, 'artifact'): [(4444, 0.1)]}, read)
+        self.assertListEqual(neighbours.cached(4445, 'artifact'),
+                             [(4444, 0.5), (4446, 0.5)])
+
+        neighbours.invalidate_many([4445])
+        read = neighbours.versions([4445])
+        neighbours.store_many({(4445, 'artifact'): [(4444, 0.5)]}, read)
+        self.assertListEqual(neighbours.cached(4445, 'artifact'),
+                             [(4444, 0.5)])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_recommend_cached_paginated(self):
+        recommender.tag_similarity(4444)
+
+        with patch('artifact_recommender.neighbours.similarity_query') as db:
+            response = self.client.get(
+                '/dataset/4444/recommend/artifact/?limit=1')
+            self.assertListEqual(json.loads(response.content), [4446])
+            response = self.client.get(
+                '/dataset/4444/recommend/artifact/?limit=1&cursor={}'.format(
+                    response['X-Next-Cursor']))
+            self.assertListEqual(json.loads(response.content), [4445])
+            response = self.client.get(
+                '/dataset/4444/recommend/artifact/?offset=1&min_score=0.2')
+            self.assertListEqual(json.loads(response.content), [4445])
+            response = self.client.get(
+                '/dataset/4444/recommend/artifact/?min_score=0.6')
+            self.assertListEqual(json.loads(response.content), [4446])
+        self.assertFalse(db.called)
+
+        # A cursor whose neighbour moved is answered by the database
+        cursor = views.encode_cursor(0.9, 4446)
+        response = self.client.get(
+            '/dataset/4444/recommend/artifact/?cursor={}'.format(cursor))
+        self.assertListEqual(json.loads(response.content), [4445])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_recommend_batch(self):
+        recommender.tag_similarity(4444)
+
+        response = self.client.post(
+            '/recommend/',
+            json.dumps([{'source': 'dataset', 'pk': 4444, 'target': 'idea'},
+                        {'source': 'dataset', 'pk': 4445,
+                         'target': 'artifact'}]),
+            content_type='application/json')
+
+        self.assertListEqual(json.loads(response.content),
+                             [[4446], [4444]])
+        self.assertListEqual(neighbours.cached(4445, 'artifact'),
+                             [(4444, 0.5)])
+        with patch('artifact_recommender.models.Similarity.objects') as db:
+            self.assertDictEqual(
+                neighbours.ranked_many([(4444, 'artifact'),
+                                        (4445, 'artifact')], 1),
+                {(4444, 'artifact'): [(4446, 1.0)],
+                 (4445, 'artifact'): [(4444, 0.5)]})
+        self.assertFalse(db.filter.called)
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_retag_invalidates_neighbours(self):
+        recommender.tag_similarity(4444)
+        self.client.get('/dataset/4445/recommend/artifact/')
+
+        Dataset.objects.get(id=4445).tags = [self.tag2]
+        recommender.tag_similarity(4445)
+
+        self.assertListEqual(neighbours.cached(4445, 'artifact'),
+                             [(4444, 0.5), (4446, 0.5)])
+        self.assertIsNone(neighbours.cached(4444, 'artifact'))
+        response = self.client.get('/dataset/4444/recommend/artifact/')
+        self.assertListEqual(json.loads(response.content), [4446, 4445])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_delete_invalidates_neighbours(self):
+        recommender.tag_similarity(4444)
+
+        Dataset.objects.get(id=4445).delete()
+
+        self.assertIsNone(neighbours.cached(4444, 'artifact'))
+        response = self.client.get('/dataset/4444/recommend/artifact/')
+        self.assertListEqual(json.loads(response.content), [4446])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_rebuild_clears_neighbours(self):
+        recommender.tag_similarity(4444)
+
+        call_command('rebuild_similarity', stdout=StringIO())
+
+        self.assertListEqual(self.redis.keys('recommend:*'), [])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_redis_unavailable(self):
+        recommender.tag_similarity(4444)
+
+        with patch.object(self.redis, 'zrange',
+                          side_effect=ConnectionError()):
+            response = self.client.get('/dataset/4444/recommend/artifact/')
+        self.assertListEqual(json.loads(response.content), [4446, 4445])
+
+    @patch('nltk.stem.snowball.SnowballStemmer.languages', ("spanish",))
+    def test_ranked_without_redis(self):
+        recommender.tag_similarity(4444)
+
+        with patch('artifact_recommender.neighbours.redis_connection',
+                   return_value=None):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertListEqual(
+                    neighbours.ranked(4444, 'artifact', limit=1, offset=1),
+                    [(4445, 0.5)])
+            self.assertIn('LIMIT 1 OFFSET 1', queries[0]['sql'])
+            self.assertListEqual(
+                neighbours.ranked(4444, 'artifact', after=(1.0, 4446)),
+                [(4445, 0.5)])
+            self.assertListEqual(
+                neighbours.ranked(4444, 'artifact', min_score=0.6),
+                [(4446, 1.0)])
+
 
 @override_settings(CACHES={
     'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
@@ -1360,6 +2601,101 @@ class ArtifactRecommendationTestCase(TestCase):
                              [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14,
                               15, 16, 17, 18, 19])
 
+    def test_dataset_recommend_all_recomputed(self):
+        recommender.tag_similarity(1)
+        recommender.tag_similarity(5)
+
+        self.assertEqual(Similarity.objects.count(), 18 * 19 / 2)
+        response = self.client.get('/dataset/1/recommend/artifact/')
+        self.assertEqual(response.status_code, 200)
+        self.assertListEqual(sorted(json.loads(response.content)),
+                             [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14,
+                              15, 16, 17, 18, 19])
+
+    def test_recommend_constant_queries(self):
+        Similarity.objects.exclude(source_artifact_id=1).exclude(
+            target_artifact_id=1).filter(source_artifact_id=2).delete()
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get('/dataset/2/recommend/artifact/')
+        self.assertListEqual(json.loads(response.content), [1])
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get('/dataset/1/recommend/artifact/')
+        self.assertEqual(len(json.loads(response.content)), 18)
+        self.assertEqual(len(few), len(many))
+
+    def test_dataset_recommend_paginated(self):
+        Similarity.objects.filter(source_artifact_id=1,
+                                  target_artifact_id=3).update(value=0.5)
+
+        response = self.client.get(
+            '/dataset/1/recommend/artifact/?limit=3&offset=1')
+        self.assertListEqual(json.loads(response.content), [4, 5, 6])
+
+        response = self.client.get('/dataset/1/recommend/artifact/?limit=2')
+        self.assertListEqual(json.loads(response.content), [2, 4])
+        response = self.client.get(
+            '/dataset/1/recommend/artifact/?limit=20&cursor={}'.format(
+                response['X-Next-Cursor']))
+        self.assertListEqual(json.loads(response.content),
+                             [5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17,
+                              18, 19, 3])
+        self.assertNotIn('X-Next-Cursor', response)
+
+        response = self.client.get(
+            '/dataset/1/recommend/dataset/?min_score=0.6')
+        self.assertListEqual(json.loads(response.content), [2, 4])
+
+    def test_dataset_recommend_paginated_bad_request(self):
+        for query in ['limit=0', 'limit=a', 'offset=-1', 'min_score=a',
+                      'cursor=a', 'cursor=MQ==']:
+            response = self.client.get(
+                '/dataset/1/recommend/artifact/?{}'.format(query))
+            self.assertEqual(response.status_code, 400)
+
+    def test_recommend_batch(self):
+        Similarity.objects.filter(source_artifact_id=1,
+                                  target_artifact_id=3).update(value=0.5)
+        requested = [{'source': 'dataset', 'pk': 1, 'target': 'dataset'},
+                     {'source': 'idea', 'pk': 15, 'target': 'app'},
+                     {'source': 'artifact', 'pk': 1, 'target': 'artifact'},
+                     {'source': 'app', 'pk': 1, 'target': 'idea'},
+                     {'source': 'dataset', 'pk': 99, 'target': 'idea'}]
+
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.post('/recommend/?limit=5',
+                                        json.dumps(requested[:1]),
+                                        content_type='application/json')
+        self.assertListEqual(json.loads(response.content), [[2, 4, 3]])
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.post('/recommend/?limit=5',
+                                        json.dumps(requested),
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertListEqual(json.loads(response.content), [
+            [2, 4, 3], [10, 11, 12, 13, 14], [2, 4, 5, 6, 7], None, None])
+        self.assertEqual(len(few), len(many))
+
+    def test_recommend_batch_bad_request(self):
+        for body in [{'source': 'dataset', 'pk': 1, 'target': 'dataset'},
+                     [{'source': 'dataset', 'pk': 1}],
+                     [{'source': 'foo', 'pk': 1, 'target': 'dataset'}],
+                     [{'source': 'dataset', 'pk': 'a', 'target': 'idea'}]]:
+            response = self.client.post('/recommend/', json.dumps(body),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    @patch('decision_engine.settings.RECOMMEND_BATCH_MAX', 2)
+    def test_recommend_batch_too_many(self):
+        requested = [{'source': 'dataset', 'pk': 1, 'target': 'dataset'}]
+        response = self.client.post('/recommend/', json.dumps(requested * 2),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/recommend/', json.dumps(requested * 3),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
     def test_buildingblock_recommend_datasets(self):
         response = self.client.get('/buildingblock/5/recommend/dataset/')
         self.assertEqual(response.status_code, 200)
@@ -1576,6 +2912,17 @@ class CDVTestCase(TestCase):
 
         self.assertCountEqual(app_list, [10, 11, 12, 13, 14])
 
+    @patch('decision_engine.settings.SIMILARITY_WEIGHTING', 'idf')
+    @patch('artifact_recommender.cdv.get_user_data')
+    def test_recommend_app_idf(self, mocked_cdv):
+        # Every app has tag1 and tag2, so only the user tags weigh
+        mocked_cdv.return_value = 35, 'Bilbao', [10, 12, 11], \
+            ['soccer', 'sports', 'tennis']
+
+        app_list = recommender.recommend_app(1, 43.2603479, -2.9334110, 50)
+
+        self.assertListEqual(app_list, [])
+
     @patch('artifact_recommender.cdv.get_user_data')
     def test_recommend_app_no_lat_lon(self, mocked_cdv):
         mocked_cdv.return_value = 35, 'Bilbao', [10, 12, 11], \
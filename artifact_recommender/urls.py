@@ -1,17 +1,26 @@
 from django.conf.urls import url
-from artifact_recommender import views
+from artifact_recommender import serializers, views
 
 urlpatterns = [
     url(r'^dataset/$', views.DatasetList.as_view()),
     url(r'^dataset/(?P<pk>[0-9]+)/$', views.DatasetDetail.as_view()),
+    url(r'^dataset/import/$', views.ArtifactImport.as_view(
+        serializer_class=serializers.DatasetSerializer)),
     url(r'^(?P<source>[\w]+)/(?P<pk>[0-9]+)/recommend/(?P<target>[\w]+)/$',
         views.ArtifactRecommendation.as_view()),
+    url(r'^recommend/$', views.ArtifactRecommendationBatch.as_view()),
     url(r'^buildingblock/$', views.BuildingBlockList.as_view()),
     url(r'^buildingblock/(?P<pk>[0-9]+)/$',
         views.BuildingBlockDetail.as_view()),
+    url(r'^buildingblock/import/$', views.ArtifactImport.as_view(
+        serializer_class=serializers.BuildingBlockSerializer)),
     url(r'^app/$', views.ApplicationList.as_view()),
     url(r'^app/(?P<pk>[0-9]+)/$', views.ApplicationDetail.as_view()),
+    url(r'^app/import/$', views.ArtifactImport.as_view(
+        serializer_class=serializers.ApplicationSerializer)),
     url(r'^idea/$', views.IdeaList.as_view()),
     url(r'^idea/(?P<pk>[0-9]+)/$', views.IdeaDetail.as_view()),
+    url(r'^idea/import/$', views.ArtifactImport.as_view(
+        serializer_class=serializers.IdeaSerializer)),
     url(r'^user/(?P<user_id>[0-9]+)/apps/$', views.UserApps.as_view()),
 ]
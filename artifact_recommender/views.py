@@ -1,16 +1,21 @@
+import base64
+import json
 from enum import Enum
 
-from artifact_recommender import recommender, serializers
+from artifact_recommender import (importer, neighbours, recommender,
+                                  serializers, tag_ids)
 from artifact_recommender.models import (Application, Artifact, BuildingBlock,
-                                         Dataset, Idea, Similarity, Tag)
-from django.core.cache import cache
+                                         Dataset, Idea)
+from artifact_recommender.parsers import NDJSONParser
+from decision_engine import settings
 from django.db import transaction
-from django.db.models import Q
-from django.http import Http404, HttpResponseBadRequest
+from django.http import (Http404, HttpResponseBadRequest,
+                         StreamingHttpResponse)
 from rest_framework import serializers as rest_serializers
 from rest_framework import status
 from rest_framework.decorators import permission_classes
-from rest_framework.permissions import IsAuthenticatedOrReadOnly
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import AllowAny, IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from silk.profiling.profiler import silk_profile
@@ -26,12 +31,74 @@ class ArtifactType(Enum):
     ARTIFACT = "artifact"
 
 
+def stream_artifacts(queryset, serializer_class):
+    # One JSON document per line, read in keyset batches by id
+    last_id = None
+    while True:
+        batch = queryset
+        if last_id is not None:
+            batch = batch.filter(pk__gt=last_id)
+        rows = serializers.artifact_rows(batch[:settings.STREAM_BATCH_SIZE],
+                                         serializer_class)
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+        if len(rows) < settings.STREAM_BATCH_SIZE:
+            return
+        last_id = rows[-1]['id']
+
+
+def list_artifacts(request, queryset, serializer_class):
+    # The whole list, a page of limit artifacts after the cursor id, or an
+    # NDJSON stream of every artifact after the cursor id
+    try:
+        queryset = queryset.order_by('pk')
+        cursor = request.query_params.get('cursor')
+        if cursor is not None:
+            queryset = queryset.filter(pk__gt=int(cursor))
+        if request.query_params.get('stream') == 'ndjson':
+            return StreamingHttpResponse(
+                stream_artifacts(queryset, serializer_class),
+                content_type='application/x-ndjson')
+        limit = request.query_params.get('limit')
+        if limit is None:
+            return Response(serializers.artifact_rows(queryset,
+                                                      serializer_class))
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit out of range')
+    except ValueError:
+        return HttpResponseBadRequest("Bad request. Is the URL correct?")
+    rows = serializers.artifact_rows(queryset[:limit], serializer_class)
+    response = Response(rows)
+    if len(rows) == limit:
+        response['X-Next-Cursor'] = str(rows[-1]['id'])
+    return response
+
+
+@permission_classes((IsAuthenticatedOrReadOnly,))
+class ArtifactImport(APIView):
+    # Bulk creation of the artifacts of one type from a JSON array or NDJSON
+    parser_classes = (JSONParser, NDJSONParser)
+    serializer_class = None
+
+    def post(self, request, format=None):
+        serializer = serializers.import_serializer(self.serializer_class)(
+            data=request.data, many=True)
+        if not serializer.is_valid():
+            return Response(serializer.errors,
+                            status=status.HTTP_400_BAD_REQUEST)
+        with silk_profile("Import artifacts"):
+            created, skipped = importer.import_artifacts(
+                self.serializer_class.Meta.model, serializer.validated_data)
+        return Response({'created': len(created), 'skipped': skipped},
+                        status=status.HTTP_201_CREATED)
+
+
 @permission_classes((IsAuthenticatedOrReadOnly,))
 class DatasetList(APIView):
     def get(self, request, format=None):
-        datasets = Dataset.objects.all()
-        serializer = serializers.DatasetSerializer(datasets, many=True)
-        return Response(serializer.data)
+        return list_artifacts(request, Dataset.objects.all(),
+                              serializers.DatasetSerializer)
 
     def post(self, request, format=None):
         with transaction.atomic():
@@ -39,13 +106,9 @@ class DatasetList(APIView):
                 stemmed_tags = recommender.stem_tags(request.data['lang'],
                                                      request.data['tags'])
             request.data['tags'] = stemmed_tags
-            for tag_name in request.data['tags']:
-                if not cache.get('tag:{}'.format(tag_name)):
-                    if not Tag.objects.filter(name=tag_name).exists():
-                        tag = Tag(name=tag_name)
-                        tag.save()
-                        cache.set('tag:{}'.format(tag_name), tag.id)
-            serializer = serializers.DatasetSerializer(data=request.data)
+            context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
+            serializer = serializers.DatasetSerializer(data=request.data,
+                                                       context=context)
             if serializer.is_valid():
                 serializer.save()
                 return Response(serializer.data,
@@ -58,7 +121,7 @@ class DatasetList(APIView):
 class DatasetDetail(APIView):
     def get_object(self, pk):
         try:
-            return Dataset.objects.get(pk=pk)
+            return Dataset.objects.prefetch_related('tags').get(pk=pk)
         except Dataset.DoesNotExist:
             raise Http404
 
@@ -73,13 +136,9 @@ class DatasetDetail(APIView):
             stemmed_tags = recommender.stem_tags(request.data['lang'],
                                                  request.data['tags'])
         request.data['tags'] = stemmed_tags
-        for tag_name in request.data['tags']:
-            if not cache.get('tag:{}'.format(tag_name)):
-                if not Tag.objects.filter(name=tag_name).exists():
-                    tag = Tag(name=tag_name)
-                    tag.save()
-                    cache.set('tag:{}'.format(tag_name), tag.id)
-        serializer = serializers.DatasetSerializer(dataset, data=request.data)
+        context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
+        serializer = serializers.DatasetSerializer(dataset, data=request.data,
+                                                   context=context)
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
@@ -91,6 +150,20 @@ class DatasetDetail(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+def encode_cursor(value, neighbour_id):
+    return base64.urlsafe_b64encode(
+        json.dumps([value, neighbour_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, neighbour_id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())
+        return float(value), int(neighbour_id)
+    except TypeError:
+        raise ValueError('Invalid cursor {}'.format(cursor))
+
+
 @permission_classes((IsAuthenticatedOrReadOnly,))
 class ArtifactRecommendation(APIView):
     def get_object(self, pk, _type):
@@ -117,41 +190,71 @@ class ArtifactRecommendation(APIView):
     def get(self, request, source, pk, target, format=None):
         try:
             artifact = self.get_object(pk, source)
+            target = ArtifactType(target).value
+            limit = request.query_params.get('limit')
+            limit = None if limit is None else int(limit)
+            offset = int(request.query_params.get('offset', 0))
+            min_score = request.query_params.get('min_score')
+            min_score = None if min_score is None else float(min_score)
+            after = request.query_params.get('cursor')
+            after = None if after is None else decode_cursor(after)
+            if (limit is not None and limit < 1) or offset < 0:
+                raise ValueError('limit and offset out of range')
             with silk_profile("Get similarity"):
-                if ArtifactType(target) == ArtifactType.ARTIFACT:
-                    similarity = Similarity.objects.filter(
-                        Q(source_artifact=artifact) |
-                        Q(target_artifact=artifact)) \
-                            .order_by('-value')
-                else:
-                    if target == 'app':
-                        target = 'application'
-                    similarity = Similarity.objects.filter(
-                        Q(source_artifact=artifact,
-                          **{'target_artifact__' + target + '__isnull':
-                             False}) |
-                        Q(target_artifact=artifact,
-                          **{'source_artifact__' + target + '__isnull':
-                             False})).order_by('-value')
-            similar_datasets = []
-            with silk_profile("Similarity loop"):
-                for sim in similarity:
-                    if sim.source_artifact.id == artifact.id:
-                        similar_datasets.append(sim.target_artifact.id)
-                    else:
-                        similar_datasets.append(sim.source_artifact.id)
-            return Response(similar_datasets)
+                similar = neighbours.ranked(artifact.id, target, limit,
+                                            offset, after, min_score)
+            response = Response([neighbour_id for neighbour_id, _ in similar])
+            if limit is not None and len(similar) == limit:
+                neighbour_id, value = similar[-1]
+                response['X-Next-Cursor'] = encode_cursor(value, neighbour_id)
+            return response
         except ValueError as e:
             return HttpResponseBadRequest("Bad request. Is the URL correct?")
 
 
+@permission_classes((AllowAny,))
+class ArtifactRecommendationBatch(APIView):
+    # Neighbour lists of many {"source", "pk", "target"} requests, in order;
+    # null for the sources that do not exist. It is a read like the
+    # recommendation GET, which anonymous clients also use, sent as POST only
+    # to carry the list, so it allows any client. At most RECOMMEND_BATCH_MAX
+    # requests are answered at once, so a call costs no more than that many
+    # GETs.
+    def post(self, request, format=None):
+        try:
+            limit = request.query_params.get('limit')
+            limit = None if limit is None else int(limit)
+            if limit is not None and limit < 1:
+                raise ValueError('limit out of range')
+            if not isinstance(request.data, list) or (
+                    len(request.data) > settings.RECOMMEND_BATCH_MAX):
+                raise ValueError('at most {} requests'.format(
+                    settings.RECOMMEND_BATCH_MAX))
+            requested = [(ArtifactType(entry['source']).value,
+                          int(entry['pk']),
+                          ArtifactType(entry['target']).value)
+                         for entry in request.data]
+        except (KeyError, TypeError, ValueError):
+            return HttpResponseBadRequest("Bad request. Is the body correct?")
+        with silk_profile("Source types"):
+            types = recommender.artifact_types(
+                set(pk for _, pk, _ in requested))
+        found = [(pk, target) for source, pk, target in requested
+                 if pk in types and
+                 source in (ArtifactType.ARTIFACT.value, types[pk])]
+        with silk_profile("Get similarities"):
+            similar = neighbours.ranked_many(found, limit)
+        return Response([[neighbour_id for neighbour_id, _ in
+                          similar[(pk, target)]]
+                         if (pk, target) in similar else None
+                         for _, pk, target in requested])
+
+
 @permission_classes((IsAuthenticatedOrReadOnly,))
 class BuildingBlockList(APIView):
     def get(self, request, format=None):
-        building_blocks = BuildingBlock.objects.all()
-        serializer = serializers.BuildingBlockSerializer(building_blocks,
-                                                         many=True)
-        return Response(serializer.data)
+        return list_artifacts(request, BuildingBlock.objects.all(),
+                              serializers.BuildingBlockSerializer)
 
     def post(self, request, format=None):
         with transaction.atomic():
@@ -159,13 +262,9 @@ class BuildingBlockList(APIView):
                 stemmed_tags = recommender.stem_tags(request.data['lang'],
                                                      request.data['tags'])
             request.data['tags'] = stemmed_tags
-            for tag_name in request.data['tags']:
-                if not cache.get('tag:{}'.format(tag_name)):
-                    if not Tag.objects.filter(name=tag_name).exists():
-                        tag = Tag(name=tag_name)
-                        tag.save()
-                        cache.set('tag:{}'.format(tag_name), tag.id)
-            serializer = serializers.BuildingBlockSerializer(data=request.data)
+            context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
+            serializer = serializers.BuildingBlockSerializer(data=request.data,
+                                                             context=context)
             if serializer.is_valid():
                 serializer.save()
                 return Response(serializer.data,
@@ -178,7 +277,7 @@ class BuildingBlockList(APIView):
 class BuildingBlockDetail(APIView):
     def get_object(self, pk):
         try:
-            return BuildingBlock.objects.get(pk=pk)
+            return BuildingBlock.objects.prefetch_related('tags').get(pk=pk)
         except BuildingBlock.DoesNotExist:
             raise Http404
 
@@ -193,14 +292,10 @@ class BuildingBlockDetail(APIView):
             stemmed_tags = recommender.stem_tags(request.data['lang'],
                                                  request.data['tags'])
         request.data['tags'] = stemmed_tags
-        for tag_name in request.data['tags']:
-            if not cache.get('tag:{}'.format(tag_name)):
-                if not Tag.objects.filter(name=tag_name).exists():
-                    tag = Tag(name=tag_name)
-                    tag.save()
-                    cache.set('tag:{}'.format(tag_name), tag.id)
+        context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
         serializer = serializers.BuildingBlockSerializer(building_block,
-                                                         data=request.data)
+                                                         data=request.data,
+                                                         context=context)
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
@@ -215,10 +310,8 @@ class BuildingBlockDetail(APIView):
 @permission_classes((IsAuthenticatedOrReadOnly,))
 class ApplicationList(APIView):
     def get(self, request, format=None):
-        apps = Application.objects.all()
-        serializer = serializers.ApplicationSerializer(apps,
-                                                       many=True)
-        return Response(serializer.data)
+        return list_artifacts(request, Application.objects.all(),
+                              serializers.ApplicationSerializer)
 
     def post(self, request, format=None):
         with transaction.atomic():
@@ -227,13 +320,9 @@ class ApplicationList(APIView):
                                                      request.data['tags'])
             request.data['tags'] = stemmed_tags
             with silk_profile(name='Saving tags'):
-                for tag_name in request.data['tags']:
-                    if not cache.get('tag:{}'.format(tag_name)):
-                        if not Tag.objects.filter(name=tag_name).exists():
-                            tag = Tag(name=tag_name)
-                            tag.save()
-                            cache.set('tag:{}'.format(tag_name), tag.id)
-            serializer = serializers.ApplicationSerializer(data=request.data)
+                context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
+            serializer = serializers.ApplicationSerializer(data=request.data,
+                                                           context=context)
             if serializer.is_valid():
                 serializer.save()
                 return Response(serializer.data,
@@ -246,7 +335,7 @@ class ApplicationList(APIView):
 class ApplicationDetail(APIView):
     def get_object(self, pk):
         try:
-            return Application.objects.get(pk=pk)
+            return Application.objects.prefetch_related('tags').get(pk=pk)
         except Application.DoesNotExist:
             raise Http404
 
@@ -260,14 +349,10 @@ class ApplicationDetail(APIView):
         stemmed_tags = recommender.stem_tags(request.data['lang'],
                                              request.data['tags'])
         request.data['tags'] = stemmed_tags
-        for tag_name in request.data['tags']:
-            if not cache.get('tag:{}'.format(tag_name)):
-                if not Tag.objects.filter(name=tag_name).exists():
-                    tag = Tag(name=tag_name)
-                    tag.save()
-                    cache.set('tag:{}'.format(tag_name), tag.id)
+        context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
         serializer = serializers.ApplicationSerializer(application,
-                                                       data=request.data)
+                                                       data=request.data,
+                                                       context=context)
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
@@ -282,10 +367,8 @@ class ApplicationDetail(APIView):
 @permission_classes((IsAuthenticatedOrReadOnly,))
 class IdeaList(APIView):
     def get(self, request, format=None):
-        ideas = Idea.objects.all()
-        serializer = serializers.IdeaSerializer(ideas,
-                                                many=True)
-        return Response(serializer.data)
+        return list_artifacts(request, Idea.objects.all(),
+                              serializers.IdeaSerializer)
 
     def post(self, request, format=None):
         with transaction.atomic():
@@ -293,13 +376,9 @@ class IdeaList(APIView):
                 stemmed_tags = recommender.stem_tags(request.data['lang'],
                                                      request.data['tags'])
             request.data['tags'] = stemmed_tags
-            for tag_name in request.data['tags']:
-                if not cache.get('tag:{}'.format(tag_name)):
-                    if not Tag.objects.filter(name=tag_name).exists():
-                        tag = Tag(name=tag_name)
-                        tag.save()
-                        cache.set('tag:{}'.format(tag_name), tag.id)
-            serializer = serializers.IdeaSerializer(data=request.data)
+            context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
+            serializer = serializers.IdeaSerializer(data=request.data,
+                                                    context=context)
             if serializer.is_valid():
                 serializer.save()
                 return Response(serializer.data,
@@ -312,7 +391,7 @@ class IdeaList(APIView):
 class IdeaDetail(APIView):
     def get_object(self, pk):
         try:
-            return Idea.objects.get(pk=pk)
+            return Idea.objects.prefetch_related('tags').get(pk=pk)
         except Idea.DoesNotExist:
             raise Http404
 
@@ -327,13 +406,9 @@ class IdeaDetail(APIView):
             stemmed_tags = recommender.stem_tags(request.data['lang'],
                                                  request.data['tags'])
         request.data['tags'] = stemmed_tags
-        for tag_name in request.data['tags']:
-            if not cache.get('tag:{}'.format(tag_name)):
-                if not Tag.objects.filter(name=tag_name).exists():
-                    tag = Tag(name=tag_name)
-                    tag.save()
-                    cache.set('tag:{}'.format(tag_name), tag.id)
-        serializer = serializers.IdeaSerializer(idea, data=request.data)
+        context = {'tag_ids': tag_ids.resolve(request.data['tags'])}
+        serializer = serializers.IdeaSerializer(idea, data=request.data,
+                                                context=context)
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
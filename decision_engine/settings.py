@@ -149,6 +149,45 @@ REDIS_DB = 1
 MAX_LEVENSHTEIN = 1
 RECOMENDATION_THRESHOLD = 0.2
 
+# MinHash/LSH candidate generation for tag similarity. When enabled, only
+# artifacts whose estimated Jaccard reaches LSH_THRESHOLD are rescored.
+SIMILARITY_LSH = False
+LSH_THRESHOLD = 0.5
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+
+# Similarities stored: those above SIMILARITY_MIN_VALUE among the
+# SIMILARITY_TOP_K most similar artifacts of each type of either artifact
+SIMILARITY_TOP_K = 100
+SIMILARITY_MIN_VALUE = 0
+
+# Similarity jobs requested while a drain job is queued are coalesced into
+# it. The queued marker expires after SIMILARITY_DEBOUNCE seconds, and each
+# drain computes SIMILARITY_DRAIN_SIZE artifacts at a time.
+SIMILARITY_DEBOUNCE = 60
+SIMILARITY_DRAIN_SIZE = 500
+
+# Set SIMILARITY_WEIGHTING to 'idf' to weight every tag by its inverse
+# document frequency in the Jaccard similarity. Tags whose IDF is below
+# SIMILARITY_MIN_IDF weigh nothing.
+SIMILARITY_WEIGHTING = None
+SIMILARITY_MIN_IDF = 0
+
+# Artifacts read per query when streaming a list as NDJSON
+STREAM_BATCH_SIZE = 500
+
+# Requests answered by one batch recommendation call
+RECOMMEND_BATCH_MAX = 100
+
+# Tag name -> id pairs kept in memory by each process
+TAG_ID_CACHE_SIZE = 10000
+
+# Artifact tag sets kept in memory by each process
+TAG_SET_CACHE_SIZE = 100000
+
+# Seconds a ranked neighbour list is kept in Redis
+NEIGHBOUR_CACHE_TTL = 86400
+
 # WeLive settings
 BASIC_USER = 'basic-user'
 BASIC_PASSWORD = 'basic-password'